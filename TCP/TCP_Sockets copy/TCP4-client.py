@@ -2,24 +2,38 @@ import socket
 import struct
 import threading
 import time
+import zlib
 
 SERVER_IP = '127.0.0.1'
 BUFFER_SIZE = 1024
-start_times = {}  # Dictionary to track start times
+HEADER_SIZE = 4  # the length field counts the header too
+PROBE = struct.Struct('>IQ')  # sequence number, perf_counter_ns when sent
+PROBE_TIMEOUT = 1.0  # seconds to wait for replies after the last probe
+COMPRESS_THRESHOLD = 128  # payload bytes below which frames are sent as they are
+COMPRESSED = 0x80  # type bit: the payload is deflated
+compressing = False  # whether the server answered our compression offer
+probe_rtts = {}  # sequence number -> round trip time in ns, of the current run
+probe_done = threading.Event()
+probe_count = 0
 
 def receive_messages(sock):
     while True:
         try:
-            header = sock.recv(4)
+            header = recv_exactly(sock, HEADER_SIZE)
             if not header:
                 break
 
             msg_type, subtype, length = struct.unpack('>BBH', header)
-            data = sock.recv(length-4).decode()
-            if msg_type == 4 and subtype == 1:  # Echo response
+            msg_type, data = inflate(msg_type, recv_exactly(sock, length - HEADER_SIZE))
+            if msg_type == 6 and subtype == 1:  # The server decodes compressed frames too
+                global compressing
+                compressing = True
+            elif msg_type == 4 and subtype == 1:  # Echo response
                 handle_echo_response(sock, data)
+            elif msg_type == 4 and subtype == 0:  # Echo request, the server checks that we're alive
+                sock.sendall(struct.pack('>BBH', 4, 1, HEADER_SIZE + len(data)) + data)
             else:
-                print(f"\nReceived: {data}")
+                print(f"\nReceived: {data.decode()}")
         except ConnectionResetError as e:
             print(f"Connection was reset: {e}")
             break
@@ -27,21 +41,81 @@ def receive_messages(sock):
             print(f"Error receiving message: {e}")
             break
 
+def send_frame(sock, frame):
+    # with the payload deflated once the server takes it, if that pays off
+    if compressing and len(frame) - HEADER_SIZE >= COMPRESS_THRESHOLD:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        payload = compressor.compress(frame[HEADER_SIZE:]) + compressor.flush()
+        if len(payload) < len(frame) - HEADER_SIZE:
+            frame = struct.pack('>BBH', frame[0] | COMPRESSED, frame[1], HEADER_SIZE + len(payload)) + payload
+    sock.sendall(frame)
+
+def inflate(msg_type, data):
+    # the type and payload of a received frame, as they were before compression
+    if not msg_type & COMPRESSED:
+        return msg_type, data
+    decompressor = zlib.decompressobj(-15)
+    data = decompressor.decompress(data, 0xFFFF)
+    if not decompressor.eof:
+        raise ConnectionAbortedError("Compressed frame is too big or cut short")
+    return msg_type & ~COMPRESSED, data
+
+def recv_exactly(sock, size):
+    # keep reading until the whole message arrived, b'' if the connection closed
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return b''
+        data += chunk
+    return data
+
 def handle_echo_response(sock, data):
-    rtt = time.time() - start_times[sock]  # Access start time from dictionary
-    print(f"RTT: {rtt}")
-    del start_times[sock]  # Clean up the entry after use
+    if len(data) < PROBE.size:
+        return
+    seq, sent_ns = PROBE.unpack_from(data)
+    probe_rtts[seq] = time.perf_counter_ns() - sent_ns
+    if len(probe_rtts) >= probe_count:
+        probe_done.set()
 
-def send_echo_request(sock):
+def send_echo_request(sock, seq, size=0):
     msg_type = 4
     subtype = 0  # Echo request
-    data = b'ECHO'
-    length = 4 + len(data)
+    data = PROBE.pack(seq, time.perf_counter_ns()).ljust(size, b'\0')
+    length = HEADER_SIZE + len(data)
     header = struct.pack('>BBH', msg_type, subtype, length)
-    
-    start_times[sock] = time.time()  # Store start time in the dictionary
-    
-    sock.send(header + data)
+    send_frame(sock, header + data)
+
+def run_probes(sock, count=10, interval=0.1, size=0):
+    # send count probes interval seconds apart without waiting for the replies,
+    # any number of them can be in flight
+    global probe_count
+    probe_rtts.clear()
+    probe_done.clear()
+    probe_count = count
+    for seq in range(count):
+        send_echo_request(sock, seq, size)
+        time.sleep(interval)
+    probe_done.wait(PROBE_TIMEOUT)
+    print_probe_summary([probe_rtts[seq] for seq in sorted(probe_rtts)], count)
+
+def percentile(ordered, p):
+    # nearest rank
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def print_probe_summary(rtts, sent):
+    # rtts in ns, in sequence order. jitter is the mean difference between consecutive rtts
+    loss = (sent - len(rtts)) / sent * 100 if sent else 0.0
+    if not rtts:
+        print(f"{sent} probes sent, 0 received, {loss:.1f}% loss")
+        return
+    ordered = sorted(rtts)
+    jitter = sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1) if len(rtts) > 1 else 0
+    ms = lambda ns: f"{ns / 1e6:.3f}"
+    print(f"{sent} probes sent, {len(rtts)} received, {loss:.1f}% loss")
+    print(f"rtt min/avg/max/jitter = {ms(ordered[0])}/{ms(sum(rtts) / len(rtts))}/{ms(ordered[-1])}/{ms(jitter)} ms")
+    print(f"rtt p50/p90/p99 = {ms(percentile(ordered, 50))}/{ms(percentile(ordered, 90))}/{ms(percentile(ordered, 99))} ms")
 
 def main():
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -49,7 +123,11 @@ def main():
 
     try:
         client.connect((SERVER_IP, server_port))
+        # let the kernel notice a server that vanished while we're idle
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         print(f"Connected to server on port {server_port}")
+        # offer compression, the server answers if it takes it too
+        client.sendall(struct.pack('>BBH', 6, 0, HEADER_SIZE))
     except ConnectionRefusedError:
         print(f"Could not connect to server on port {server_port}")
         return
@@ -58,14 +136,27 @@ def main():
     recv_thread.start()
 
     while True:
-        msg = input("Enter message to send or 'exit' to quit: ")
+        msg = input("Enter message to send, 'echo [count] [interval ms] [size]', 'join <channel>', "
+                    "'leave <channel>', '#<channel> <message>' or 'exit' to quit: ")
         if msg.lower() == 'exit':
             client.close()
             break
-        elif msg.lower() == 'echo':
-            send_echo_request(client)
+        elif msg.lower().split(' ')[0] == 'echo':
+            # echo [count] [interval ms] [payload size]
+            options = [float(value) for value in msg.split()[1:4]]
+            count, interval, size = options + [10, 100, 0][len(options):]
+            run_probes(client, int(count), interval / 1000, int(size))
+        elif msg.lower().split(' ')[0] in ('join', 'leave'):
+            data = msg.split(' ', 1)[1].strip().lstrip('#').encode()
+            subtype = 0 if msg.lower().startswith('join') else 1
+            send_frame(client, struct.pack('>BBH', 5, subtype, HEADER_SIZE + len(data)) + data)
+        elif msg.startswith('#'):
+            data = msg[1:].encode()
+            send_frame(client, struct.pack('>BBH', 5, 2, HEADER_SIZE + len(data)) + data)
         else:
-            client.send(msg.encode())
+            data = msg.encode()
+            header = struct.pack('>BBH', 3, 0, HEADER_SIZE + len(data))
+            send_frame(client, header + data)
 
 if __name__ == "__main__":
     main()
@@ -1,32 +1,319 @@
+import argparse
+import collections
+import itertools
 import socket
 import struct
 import threading
 import time
+import zlib
 
 SERVER_IP = '127.0.0.1'
 PORTS = [3000, 3001, 3002, 3003, 3004]
+HEADER_SIZE = 4  # the length field counts the header too
+# peer connections
+KEEPALIVE_INTERVAL = 5.0  # seconds a peer may stay silent before it is probed
+KEEPALIVE_MISSES = 3      # unanswered probes before a peer is considered dead
+BACKOFF_INITIAL = 0.5     # first reconnect delay, doubled on every failed attempt
+BACKOFF_MAX = 30.0
+MAX_IN_FLIGHT = 8         # unanswered requests allowed per peer
+REQUEST_TIMEOUT = 2.0
+LOOKUP_DEADLINE = 1.0     # seconds a message waits for the peers to locate its recipient
+# client connections
+CLIENT_HEARTBEAT = 10.0     # seconds a client may stay silent before it is probed
+CLIENT_IDLE_TIMEOUT = 30.0  # seconds of silence before the connection is closed
+# recipient cache
+CACHE_SIZE = 4096
+CACHE_TTL = 30.0          # seconds a located recipient is trusted without asking again
+# compression, offered with a type 6 frame (0 offer, 1 answer) and used towards the other
+# end once it offered too. a compressed frame has this bit set in its type
+COMPRESS_THRESHOLD = 128  # payload bytes below which frames are sent as they are
+COMPRESS_LEVEL = 6
+COMPRESSED = 0x80
 port_index = 0
 servers = {}
 users = {}
 sockets = {}
+last_seen = {}  # accepted socket -> time its last message arrived
+compressing = set()  # sockets whose other end decodes compressed frames
+compression_stats = {'frames': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'cpu_seconds': 0.0}
+compression_lock = threading.Lock()  # every client and peer thread updates the stats
+# channels, subscriber sets are replaced rather than changed so publishes read them without the lock
+channels = {}       # channel -> frozenset of subscribed client sockets
+subscribed = {}     # client socket -> set of channels it subscribed to
+channel_peers = {}  # channel -> set of peer addresses with subscribers
+channels_lock = threading.Lock()
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+class Peer:
+    # a long-lived connection to another server, reused for every lookup and forward.
+    # requests carry an id that the answer echoes, so any number of them can be
+    # outstanding and answered in any order.
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.lock = threading.Lock()  # guards the socket, writes and the pending requests
+        self.in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> callback taking the answer, or None if there is none
+        self.backoff = BACKOFF_INITIAL
+        self.retry_at = 0.0
+        self.last_seen = 0.0
+
+    def connect(self):
+        # make sure the connection is up, False while it is down and waiting for a retry
+        with self.lock:
+            if self.sock is not None:
+                return True
+            if time.monotonic() < self.retry_at:
+                return False
+            try:
+                sock = socket.create_connection(self.address, timeout=REQUEST_TIMEOUT)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                set_keepalive(sock)
+                # register as a server
+                name = str(PORTS[port_index]).encode()
+                sock.sendall(struct.pack('>BBH', 2, 0, HEADER_SIZE + len(name)) + name)
+                # offer compression, the answer comes in on the reader thread
+                sock.sendall(struct.pack('>BBH', 6, 0, HEADER_SIZE))
+                # and tell it which channels we want publishes for
+                with channels_lock:
+                    wanted = '\0'.join(channels).encode()
+                if wanted:
+                    sock.sendall(struct.pack('>BBH', 5, 4, HEADER_SIZE + len(wanted)) + wanted)
+            except OSError as err:
+                print(f'Connection to {self.address} failed, retrying in {self.backoff}s.\n\t{err}')
+                self.retry_at = time.monotonic() + self.backoff
+                self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+                return False
+
+            print(f'Connection with {self.address} established.')
+            self.sock = sock
+            self.backoff = BACKOFF_INITIAL
+            self.last_seen = time.monotonic()
+        threading.Thread(target=self.read, args=(sock,), daemon=True).start()
+        return True
+
+    def send(self, header, data=b''):
+        if not self.connect():
+            return False
+        with self.lock:
+            if self.sock is None:
+                return False
+            try:
+                self.sock.sendall(compress_frame(self.sock, header + data))
+                return True
+            except OSError as err:
+                self.drop(err)
+                return False
+
+    def request(self, subtype, data, callback):
+        # send a request without waiting for it, the reader thread passes the answer to callback.
+        # returns the request id, or None without calling callback if the peer is down or has
+        # too many requests in flight
+        if not self.in_flight.acquire(blocking=False):
+            return None
+        with self.lock:
+            if self.sock is None:
+                self.in_flight.release()
+                return None
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            data = struct.pack('>I', request_id) + data
+            self.pending[request_id] = callback
+            try:
+                self.sock.sendall(compress_frame(self.sock, struct.pack('>BBH', 0, subtype, HEADER_SIZE + len(data)) + data))
+            except OSError as err:
+                # forgotten before the drop, so the callback isn't called on top of returning None
+                del self.pending[request_id]
+                self.in_flight.release()
+                self.drop(err)
+                return None
+        return request_id
+
+    def cancel(self, request_id):
+        # forget a request, its answer is ignored if it still arrives
+        with self.lock:
+            if self.pending.pop(request_id, None) is not None:
+                self.in_flight.release()
+
+    def check(self):
+        # reconnect a peer that is down, probe one that went quiet, and drop a dead one
+        if not self.connect():
+            return
+        silence = time.monotonic() - self.last_seen
+        if silence > KEEPALIVE_INTERVAL * KEEPALIVE_MISSES:
+            with self.lock:
+                self.drop('the peer stopped answering')
+        elif silence > KEEPALIVE_INTERVAL:
+            self.send(struct.pack('>BBH', 4, 0, HEADER_SIZE))
+
+    def read(self, sock):
+        try:
+            while True:
+                header = recv_exactly(sock, HEADER_SIZE)
+                if not header:
+                    break
+                msg_type, subtype, length = struct.unpack('>BBH', header)
+                msg_type, data = inflate(msg_type, recv_exactly(sock, length - HEADER_SIZE))
+                self.last_seen = time.monotonic()
+
+                # answers to requests, echo responses only mark the peer as alive
+                if msg_type == 1 and subtype == 2:
+                    request_id, = struct.unpack_from('>I', data)
+                    with self.lock:
+                        callback = self.pending.pop(request_id, None)
+                    if callback is not None:
+                        self.in_flight.release()
+                        callback(data[4:])
+                # a forwarded message found its recipient gone
+                elif msg_type == 1 and subtype == 3:
+                    recipients.invalidate(data.decode(), self)
+                # the peer checks that we're alive
+                elif msg_type == 4 and subtype == 0:
+                    self.send(struct.pack('>BBH', 4, 1, HEADER_SIZE + len(data)), data)
+                # the peer answered our compression offer
+                elif msg_type == 6 and subtype == 1:
+                    compressing.add(sock)
+        except OSError:
+            pass
+
+        with self.lock:
+            if self.sock is sock:
+                self.drop('connection closed')
+
+    def drop(self, reason):
+        # called with the lock held, the next check reconnects
+        print(f'Connection with {self.address} lost: {reason}')
+        compressing.discard(self.sock)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        self.retry_at = time.monotonic()
+        recipients.invalidate_peer(self)
+        for callback in self.pending.values():
+            self.in_flight.release()
+            callback(None)
+        self.pending.clear()
+
+class PeerPool:
+    # one Peer per known server, kept healthy by a background thread
+    def __init__(self):
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def add(self, address):
+        with self.lock:
+            if address not in self.peers:
+                self.peers[address] = Peer(address)
+            return self.peers[address]
+
+    def all(self):
+        with self.lock:
+            return list(self.peers.values())
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            for peer in self.all():
+                peer.check()
+            time.sleep(BACKOFF_INITIAL)
+
+class RecipientCache:
+    # recipient -> peer it was found on, least recently used entries are evicted first
+    # and entries expire after CACHE_TTL. stale entries are dropped when the peer goes
+    # down, reports the recipient gone, or a forward to it fails.
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # recipient -> (peer, expiry time)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, recipient):
+        with self.lock:
+            peer, expires = self.entries.get(recipient, (None, 0.0))
+            if peer is None or time.monotonic() >= expires:
+                self.entries.pop(recipient, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(recipient)
+            self.hits += 1
+            return peer
+
+    def put(self, recipient, peer):
+        with self.lock:
+            self.entries[recipient] = (peer, time.monotonic() + self.ttl)
+            self.entries.move_to_end(recipient)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, recipient, peer):
+        with self.lock:
+            if self.entries.get(recipient, (None,))[0] is peer:
+                del self.entries[recipient]
+                self.invalidations += 1
+
+    def invalidate_peer(self, peer):
+        with self.lock:
+            for recipient in [r for r, (p, _) in self.entries.items() if p is peer]:
+                del self.entries[recipient]
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'invalidations': self.invalidations}
+
+class Lookup:
+    # a recipient lookup sent to several peers at once, settled by the first positive
+    # answer, or once every peer answered negatively
+    def __init__(self, count):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.remaining = count
+        self.found = None
+        if count == 0:
+            self.done.set()
+
+    def answer(self, peer, answer):
+        with self.lock:
+            self.remaining -= 1
+            if answer == b'\1' and self.found is None:
+                self.found = peer
+            if self.found is not None or self.remaining <= 0:
+                self.done.set()
+
+peers = PeerPool()
+recipients = RecipientCache()
+
 def handle_client(client_socket, client_address):
+    last_seen[client_socket] = time.monotonic()
     while True:
         try:
-            header = client_socket.recv(4)
+            header = recv_exactly(client_socket, HEADER_SIZE)
             if not header:
                 break
 
             msg_type, subtype, length = struct.unpack('>BBH', header)
-            data = client_socket.recv(length - 4)
+            msg_type, data = inflate(msg_type, recv_exactly(client_socket, length - HEADER_SIZE))
+            last_seen[client_socket] = time.monotonic()
 
             if msg_type == 0:  # Request information about connections
                 if subtype == 0:  # of servers
-                    response = construct_response(0, 0, servers)
+                    response = construct_response(1, 0, servers)
                 elif subtype == 1:  # of clients
-                    response = construct_response(0, 1, users)
-                client_socket.send(response)
+                    response = construct_response(1, 1, users)
+                elif subtype == 2:  # whether a client is connected here, answered with the request id
+                    request_id, name = data[:4], data[4:].decode()
+                    response = struct.pack('>BBH', 1, 2, HEADER_SIZE + 5) + request_id
+                    response += b'\1' if name in sockets else b'\0'
+                client_socket.sendall(compress_frame(client_socket, response))
 
             elif msg_type == 1:  # Answer to a request for information
                 process_info_response(subtype, data)
@@ -39,6 +326,20 @@ def handle_client(client_socket, client_address):
                     print(f"User {username} connected from {client_address}")
                 else:  # server
                     servers[client_address] = username
+                    # a restarted server tells us its channels again
+                    set_peer_interest(peer_address(client_address), [], joined=False, everything=True)
+
+            elif msg_type == 5:  # Channels
+                handle_channel(client_socket, client_address, subtype, data)
+
+            elif msg_type == 3 and subtype == 1:  # Message forwarded by another server
+                sender, dest, message = data.decode().split(' ', 2)
+                if dest in sockets:
+                    send_message(client_socket, sender, dest, message)
+                else:
+                    # let the sending server know its cached location is stale
+                    notice = dest.encode()
+                    send_via_socket(client_socket, struct.pack('>BBH', 1, 3, HEADER_SIZE + len(notice)), notice)
 
             elif msg_type == 3:  # Send message
                 dest, message = data.decode().split(' ', 1)
@@ -49,7 +350,11 @@ def handle_client(client_socket, client_address):
 
             elif msg_type == 4:  # Echo message for RTT calculation
                 if subtype == 0:  # Echo request
-                    send_echo_response(client_socket)
+                    send_echo_response(client_socket, data)
+
+            elif msg_type == 6 and subtype == 0:  # Compression offer, answered with ours
+                compressing.add(client_socket)
+                client_socket.sendall(struct.pack('>BBH', 6, 1, HEADER_SIZE))
 
         except ConnectionResetError as e:
             print(f"Client {client_address} disconnected unexpectedly: {e}")
@@ -59,21 +364,178 @@ def handle_client(client_socket, client_address):
             break
 
     client_socket.close()
+    last_seen.pop(client_socket, None)
+    compressing.discard(client_socket)
+    unsubscribe(client_socket, list(subscribed.get(client_socket, ())))
     if client_address in users:
         del sockets[users[client_address]]
         del users[client_address]
     elif client_address in servers:
         del servers[client_address]
 
-def send_via_socket(sock, header, data=None):
-    if data is None:
-        return
+def handle_channel(client_socket, client_address, subtype, data):
+    if subtype == 0:  # Subscribe
+        subscribe(client_socket, data.decode())
+    elif subtype == 1:  # Unsubscribe
+        unsubscribe(client_socket, [data.decode()])
+    elif subtype == 2:  # Publish from a client, to our subscribers and the servers with subscribers
+        channel, message = data.decode().split(' ', 1)
+        sender = users.get(client_address, '?')
+        deliver(sender, channel, message)
+        with channels_lock:
+            addresses = list(channel_peers.get(channel, ()))
+        forwarded = f'{sender} {channel} {message}'.encode()
+        for address in addresses:
+            peers.add(address).send(struct.pack('>BBH', 5, 3, HEADER_SIZE + len(forwarded)), forwarded)
+    elif subtype == 3:  # Publish forwarded by another server, only to our subscribers
+        sender, channel, message = data.decode().split(' ', 2)
+        deliver(sender, channel, message)
+    elif subtype in (4, 5):  # A server gained or lost subscribers for these channels
+        names = [name for name in data.decode().split('\0') if name]
+        set_peer_interest(peer_address(client_address), names, joined=subtype == 4)
+
+def deliver(sender, channel, message):
+    # encoded once, every subscriber is sent the same bytes
+    body = f'{sender}\0{"->"}\0#{channel}\0{":"}\0{message}'.encode()
+    frame = struct.pack('>BBH', 5, 2, HEADER_SIZE + len(body)) + body
+    for subscriber in channels.get(channel, ()):
+        send_via_socket(subscriber, frame)
 
+def subscribe(client_socket, channel):
+    with channels_lock:
+        first = channel not in channels
+        channels[channel] = channels.get(channel, frozenset()) | {client_socket}
+        subscribed.setdefault(client_socket, set()).add(channel)
+    if first:
+        announce_interest([channel], joined=True)
+
+def unsubscribe(client_socket, names):
+    emptied = []
+    with channels_lock:
+        for channel in names:
+            members = channels.get(channel, frozenset()) - {client_socket}
+            if members:
+                channels[channel] = members
+            elif channels.pop(channel, None) is not None:
+                emptied.append(channel)
+            subscribed.get(client_socket, set()).discard(channel)
+        if not subscribed.get(client_socket):
+            subscribed.pop(client_socket, None)
+    if emptied:
+        announce_interest(emptied, joined=False)
+
+def announce_interest(names, joined):
+    # only servers with subscribers are sent a channel's publishes
+    data = '\0'.join(names).encode()
+    header = struct.pack('>BBH', 5, 4 if joined else 5, HEADER_SIZE + len(data))
+    for peer in peers.all():
+        peer.send(header, data)
+
+def set_peer_interest(address, names, joined, everything=False):
+    with channels_lock:
+        if everything:
+            for channel in list(channel_peers):
+                channel_peers[channel].discard(address)
+                if not channel_peers[channel]:
+                    del channel_peers[channel]
+        for channel in names:
+            if joined:
+                channel_peers.setdefault(channel, set()).add(address)
+            elif address in channel_peers.get(channel, ()):
+                channel_peers[channel].discard(address)
+                if not channel_peers[channel]:
+                    del channel_peers[channel]
+
+def peer_address(client_address):
+    # servers register with their listening port
+    return (SERVER_IP, int(servers.get(client_address, 0)))
+
+def report_stats(interval):
+    # statistics every interval seconds, off the forwarding path
+    while True:
+        time.sleep(interval)
+        print(f"Recipient cache: {recipients.stats()}")
+        with compression_lock:
+            stats = dict(compression_stats)
+        print(f"Compression: {stats}")
+
+def reap_idle_clients():
+    # probe connections that went quiet, and shut down the ones that stayed quiet, so
+    # their thread ends and their entries are removed
+    while True:
+        time.sleep(CLIENT_HEARTBEAT / 2)
+        now = time.monotonic()
+        for sock, seen in list(last_seen.items()):
+            if now - seen > CLIENT_IDLE_TIMEOUT:
+                print(f"Connection idle for {now - seen:.1f}s, closing it.")
+                last_seen.pop(sock, None)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            elif now - seen > CLIENT_HEARTBEAT:
+                send_via_socket(sock, struct.pack('>BBH', 4, 0, HEADER_SIZE))
+
+def recv_exactly(sock, size):
+    # keep reading until the whole message arrived, b'' if the connection closed
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return b''
+        data += chunk
+    return data
+
+def set_keepalive(sock):
+    # let the kernel notice dead peers too, where the options are available
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # unacknowledged writes give up after the same time
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_INTERVAL), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_MISSES),
+                          ('TCP_USER_TIMEOUT', KEEPALIVE_INTERVAL * (KEEPALIVE_MISSES + 1) * 1000)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+
+def send_via_socket(sock, header, data=None):
     try:
-        sock.send(header + data)
+        sock.sendall(compress_frame(sock, header + (data or b'')))
     except Exception as err:
         print(f"Error sending message data: {err}")
 
+def compress_frame(sock, frame):
+    # the frame with its payload deflated, for sockets that decode it and when it pays off
+    if sock not in compressing or len(frame) - HEADER_SIZE < COMPRESS_THRESHOLD:
+        return frame
+    started = time.thread_time()
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    payload = compressor.compress(frame[HEADER_SIZE:]) + compressor.flush()
+    elapsed = time.thread_time() - started
+    with compression_lock:
+        compression_stats['cpu_seconds'] += elapsed
+        if len(payload) >= len(frame) - HEADER_SIZE:
+            return frame
+        compression_stats['frames'] += 1
+        compression_stats['raw_bytes'] += len(frame) - HEADER_SIZE
+        compression_stats['wire_bytes'] += len(payload)
+    return struct.pack('>BBH', frame[0] | COMPRESSED, frame[1], HEADER_SIZE + len(payload)) + payload
+
+def inflate(msg_type, data):
+    # the type and payload of a received frame, as they were before compression
+    if not msg_type & COMPRESSED:
+        return msg_type, data
+    started = time.thread_time()
+    try:
+        decompressor = zlib.decompressobj(-15)
+        data = decompressor.decompress(data, 0xFFFF)
+    except zlib.error as err:
+        raise ConnectionAbortedError(f"Could not decompress a frame: {err}")
+    if not decompressor.eof:
+        raise ConnectionAbortedError("Compressed frame is too big or cut short")
+    elapsed = time.thread_time() - started
+    with compression_lock:
+        compression_stats['cpu_seconds'] += elapsed
+    return msg_type & ~COMPRESSED, data
+
 def send_message(server_sock, sender, recipient, data):
     recipient_socket = sockets.get(recipient)
     if recipient_socket:
@@ -82,24 +544,24 @@ def send_message(server_sock, sender, recipient, data):
         bytes_message = message.encode()
         _type = 3
         _sub_type = 0
-        _len = len(bytes_message)
+        _len = HEADER_SIZE + len(bytes_message)
         _sub_len = len(bytes_recipient)
         bytes_header = struct.pack('>BBH', _type, _sub_type, _len)
         send_via_socket(recipient_socket, bytes_header, bytes_message)
     else:
         print(f"Recipient {recipient} not found")
 
-def send_echo_response(client_socket):
+def send_echo_response(client_socket, data):
+    # the probe's payload (sequence number and send time) goes back untouched
     _type = 4
     _sub_type = 1  # Echo response
-    data = b'ECHO'
-    length = 4 + len(data)
+    length = HEADER_SIZE + len(data)
     header = struct.pack('>BBH', _type, _sub_type, length)
     send_via_socket(client_socket, header, data)
 
 def construct_response(msg_type, subtype, data_dict):
     data = '\0'.join(f"{addr}:{name}" for addr, name in data_dict.items()).encode()
-    header = struct.pack('>BBH', msg_type, subtype, len(data))
+    header = struct.pack('>BBH', msg_type, subtype, HEADER_SIZE + len(data))
     return header + data
 
 def process_info_response(subtype, data):
@@ -109,96 +571,95 @@ def process_info_response(subtype, data):
     else:
         users.update(dict(item.split(':') for item in info))
 
+def forward_message(peer, sender, recipient, message):
+    data = f'{sender} {recipient} {message}'.encode()
+    header = struct.pack('>BBH', 3, 1, HEADER_SIZE + len(data))
+    return peer.send(header, data)
+
 def query_servers_for_recipient(sender_socket, sender, recipient, message):
-    for conn_server in servers.items():
-        try:
-            print(f"Querying server at {conn_server} for recipient {recipient}...")
-            data = message.encode()
-            length = 4 + len(data)
-            header = struct.pack('>BBH', 0, 1, length)
-            send_via_socket(conn_server, header, data)
-            server.connect(conn_server)
-            response_header = server.recv(4)
-            if response_header:
-                msg_type, subtype, length = struct.unpack('>BBH', response_header)
-                response_data = server.recv(length - 4)
-                process_info_response(subtype, response_data)
-                    
-                if recipient in users.values():
-                    print(f"Recipient {recipient} found on server {conn_server}. Forwarding message...")
-                    send_message(conn_server, sender, recipient, message)
-                    break
-        except Exception as e:
-            print(f"Error querying server {conn_server}: {e}")
+    # recipients found before are sent straight to their server
+    peer = recipients.get(recipient)
+    if peer is not None:
+        if forward_message(peer, sender, recipient, message):
+            return
+        recipients.invalidate(recipient, peer)
+
+    # ask every peer at once, and wait for the first one holding the recipient
+    candidates = peers.all()
+    lookup = Lookup(len(candidates))
+    requests = []
+    print(f"Querying {len(candidates)} servers for recipient {recipient}...")
+    for peer in candidates:
+        request_id = peer.request(2, recipient.encode(), lambda answer, peer=peer: lookup.answer(peer, answer))
+        if request_id is None:
+            lookup.answer(peer, None)
+        else:
+            requests.append((peer, request_id))
+
+    # a dead or slow peer can hold the message up to the deadline, not longer
+    lookup.done.wait(LOOKUP_DEADLINE)
+    for peer, request_id in requests:
+        peer.cancel(request_id)
+
+    if lookup.found is not None:
+        print(f"Recipient {recipient} found on server {lookup.found.address}. Forwarding message...")
+        recipients.put(recipient, lookup.found)
+        forward_message(lookup.found, sender, recipient, message)
+    else:
+        print(f"Recipient {recipient} not found")
 
 def request_servers(server_sock: socket.socket) -> None:
     _type = 0
     _sub_type = 0
-    _len = 0
+    _len = HEADER_SIZE
     bytes_header = struct.pack('>BBH', _type, _sub_type, _len)
     send_via_socket(server_sock, bytes_header)
 
 def request_clients(server_sock: socket.socket) -> None:
     _type = 0
     _sub_type = 1
-    _len = 0
+    _len = HEADER_SIZE
     bytes_header = struct.pack('>BBH', _type, _sub_type, _len)
     send_via_socket(server_sock, bytes_header)
 
 def connect_to_servers(addresses: list[tuple[str, int]]) -> None:
-    global servers
-
+    # the pool connects in the background, and keeps retrying the ones that are down
     for ip, port in addresses:
-        if ip == SERVER_IP and port in PORTS[port_index]:
-            continue
-        if (ip, port) in servers.keys():
+        if ip == SERVER_IP and port == PORTS[port_index]:
             continue
-
-        try:
-            server.connect((ip, port))
-            print(f'Connection with {(ip, port)} established.')
-        except OSError as err:
-            print(f'Connection to {(ip, port)} failed.\n\t{err}')
-
-        if server is None:
-            continue
-        servers[(ip, port)] = server
+        peers.add((ip, port))
 
 def connect_all():
-    for port in PORTS:
-        if port == PORTS[port_index]:
-            continue
-        addr = SERVER_IP
-        try:
-            server.connect((addr, PORTS[port_index]))
-            print(f'Connection with {(addr, PORTS[port_index])} established.')
-        except OSError as err:
-            print(f'Connection to {(addr, PORTS[port_index])} failed.\n\t{err}')
-
-        if server is not None:
-            servers[addr] = server
-            print(f'Requesting server list from {addr}.')
-            addresses = request_servers(server)
-            if addresses is None:
-                print(f'Failed to retrieve server list from {addr}.')
-                continue
-            print(f'Received server list from {addr}.')
-            connect_to_servers(addresses)
-            break
+    connect_to_servers([(SERVER_IP, port) for port in PORTS])
+    peers.start()
 
 def main():
+    global port_index
+
+    parser = argparse.ArgumentParser(description='TCP4 chat server')
+    parser.add_argument('--stats', type=float, default=0, metavar='SECONDS',
+                        help='print the recipient cache and compression statistics this often (0 disables)')
+    args = parser.parse_args()
+
     print('Select a port:')
     for p in range(len(PORTS)):
         print(f'{p}. {PORTS[p]}')
 
     port_index = int(input())
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(('0.0.0.0', PORTS[port_index]))
     server.listen(5)
     print(f"Server listening on port {PORTS[port_index]}")
     connect_all()
+    threading.Thread(target=reap_idle_clients, daemon=True).start()
+    if args.stats > 0:
+        threading.Thread(target=report_stats, args=(args.stats,), daemon=True).start()
 
     while True:
         client_socket, client_address = server.accept()
+        # lookups are small request/answer pairs, don't let nagle hold them back
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        set_keepalive(client_socket)
         client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
         client_thread.start()
 
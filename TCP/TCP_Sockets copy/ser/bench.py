@@ -0,0 +1,259 @@
+import argparse, asyncio, json, os, random, signal, socket, subprocess, sys, time
+import shared
+
+# load generator: starts a mesh of s.py nodes on localhost, connects synthetic clients
+# speaking the shared protocol, drives a message pattern through the mesh and reports
+# throughput and latency percentiles as json.
+#
+#   local  - every message goes to a client on the sender's node
+#   cross  - every message goes to a client on another node
+#   fanout - every message goes to --fanout clients anywhere in the mesh
+#
+# message payloads carry their send time, clients and nodes share the host's clock.
+# runs are seeded, so the same options produce the same pairs and schedule.
+
+_PATTERNS      = ('local', 'cross', 'fanout')
+_START_TIMEOUT = 10.0  # seconds a node gets to start listening
+_CONNECT_BATCH = 200   # clients connecting at the same time
+_PERCENTILES   = (50, 90, 99, 99.9)
+
+class Client:
+    def __init__(self, index: int, node: int) -> None:
+        self.name   = f'bench{index}'
+        self.node   = node
+        self.reader = None
+        self.writer = None
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(shared._LOCALHOST, shared._PORTS[self.node])
+        bytes_username = self.name.encode()
+        self.writer.write(shared.pack_header(2, 1, len(bytes_username), 0) + bytes_username)
+        await self.writer.drain()
+
+    def send(self, recipient: str, seq: int, size: int) -> None:
+        data = f'{time.perf_counter_ns()} {seq} '.encode().ljust(size, b'x')
+        bytes_recipient = recipient.encode()
+        bytes_message = self.name.encode() + b'\0' + bytes_recipient + b'\0' + data
+        self.writer.write(shared.pack_header(3, 0, len(bytes_message), len(bytes_recipient)) + bytes_message)
+
+    async def receive(self, results: 'Results') -> None:
+        try:
+            while True:
+                header = shared._HEADER.unpack(await self.reader.readexactly(shared._HEADER_SIZE))
+                payload = await self.reader.readexactly(header[2]) if header[2] else b''
+                if header[0] == 7 and header[1] == shared._HEARTBEAT_PING:
+                    self.writer.write(shared.pack_header(7, shared._HEARTBEAT_PONG, 0, 0))
+                if header[0] != 3:
+                    continue
+                _, _, data = payload.split(b'\0', 2)
+                sent_ns, seq, _ = data.split(b' ', 2)
+                results.record(int(seq), time.perf_counter_ns() - int(sent_ns))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+class Results:
+    def __init__(self, expected: int, warmup: int) -> None:
+        self.expected  = expected
+        self.warmup    = warmup
+        self.received  = 0
+        self.latencies = []
+        self.first     = None
+        self.last      = None
+        self.done      = asyncio.Event()
+
+    def record(self, seq: int, latency_ns: int) -> None:
+        self.received += 1
+        if seq >= self.warmup:
+            now = time.perf_counter()
+            self.first = self.first or now
+            self.last  = now
+            self.latencies.append(latency_ns)
+        if self.received >= self.expected:
+            self.done.set()
+
+def percentile(ordered: list, p: float) -> float:
+    # nearest rank
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def plan(clients: list[Client], nodes: int, pattern: str, messages: int, fanout: int,
+         rng: random.Random) -> list[tuple[Client, list[str]]]:
+    # pick the sender and recipients of every message
+    by_node = [[c for c in clients if c.node == node] for node in range(nodes)]
+    schedule = []
+    for index in range(messages):
+        sender = clients[index % len(clients)]
+        if pattern == 'local':
+            candidates = [c for c in by_node[sender.node] if c is not sender]
+            recipients = [rng.choice(candidates).name]
+        elif pattern == 'cross':
+            other = rng.choice([node for node in range(nodes) if node != sender.node])
+            recipients = [rng.choice(by_node[other]).name]
+        else:
+            recipients = [c.name for c in rng.sample([c for c in clients if c is not sender], fanout)]
+        schedule.append((sender, recipients))
+    return schedule
+
+async def drive(schedule: list, rate: float, size: int) -> float:
+    # send the schedule, evenly spaced at rate messages per second, or as fast as the
+    # connections take them without a rate. returns when the last message was sent
+    start = time.perf_counter()
+    for seq, (sender, recipients) in enumerate(schedule):
+        if rate > 0:
+            delay = start + seq / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        for recipient in recipients:
+            sender.send(recipient, seq, size)
+        if rate <= 0 or sender.writer.transport.get_write_buffer_size() > 64 * 1024:
+            await sender.writer.drain()
+    return time.perf_counter()
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    clients = [Client(index, index % args.nodes) for index in range(args.clients)]
+    for first in range(0, len(clients), _CONNECT_BATCH):
+        await asyncio.gather(*(c.connect() for c in clients[first:first + _CONNECT_BATCH]))
+
+    # let the registrations spread through the mesh
+    await asyncio.sleep(args.settle)
+
+    schedule = plan(clients, args.nodes, args.pattern, args.messages, args.fanout, rng)
+    expected = sum(len(recipients) for _, recipients in schedule)
+    results = Results(expected, int(args.messages * args.warmup))
+    receivers = [asyncio.create_task(c.receive(results)) for c in clients]
+
+    await drive(schedule, args.rate, args.size)
+    try:
+        await asyncio.wait_for(results.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    for c in clients:
+        c.close()
+    for receiver in receivers:
+        receiver.cancel()
+
+    measured = sorted(results.latencies)
+    duration = (results.last - results.first) if measured and results.last > results.first else 0.0
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'expected':     expected,
+        'received':     results.received,
+        'lost':         expected - results.received,
+        'duration_s':   round(duration, 6),
+        'msgs_per_sec': round(len(measured) / duration, 1) if duration else 0.0,
+        'latency_ms': {
+            **{f'p{p:g}'.replace('.', ''): round(percentile(measured, p) / 1e6, 3) for p in _PERCENTILES},
+            'mean': round(sum(measured) / len(measured) / 1e6, 3) if measured else 0.0,
+            'max':  round(measured[-1] / 1e6, 3) if measured else 0.0,
+        },
+    }
+
+def compare(result: dict, baseline: dict) -> dict:
+    # relative change against a previous run, positive is more throughput / more latency
+    def change(new: float, old: float) -> float:
+        return round((new - old) / old, 4) if old else 0.0
+
+    return {
+        'msgs_per_sec': change(result['msgs_per_sec'], baseline['msgs_per_sec']),
+        'latency_ms': {key: change(value, baseline['latency_ms'].get(key, 0.0))
+                       for key, value in result['latency_ms'].items()},
+    }
+
+def start_mesh(count: int, server_args: list[str]) -> list[subprocess.Popen]:
+    nodes = []
+    for index in range(count):
+        # each node in its own session, so its worker processes are stopped along with it
+        node = subprocess.Popen([sys.executable, 's.py', *server_args], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                text=True, start_new_session=True)
+        node.stdin.write(f'{index}\n')
+        node.stdin.flush()
+        nodes.append(node)
+        if not wait_for_port(shared._PORTS[index]):
+            stop_mesh(nodes)
+            raise RuntimeError(f'node {index} did not start listening on {shared._PORTS[index]}')
+    return nodes
+
+def wait_for_port(port: int) -> bool:
+    deadline = time.monotonic() + _START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((shared._LOCALHOST, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def stop_mesh(nodes: list[subprocess.Popen]) -> None:
+    for node in nodes:
+        try:
+            os.killpg(node.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        node.wait()
+
+def raise_file_limit() -> None:
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+parser = argparse.ArgumentParser(description='load test a local s.py mesh')
+parser.add_argument('--nodes', type=int, default=2, choices=range(1, len(shared._PORTS) + 1))
+parser.add_argument('--clients', type=int, default=100)
+parser.add_argument('--pattern', choices=_PATTERNS, default='cross')
+parser.add_argument('--messages', type=int, default=10000, help='messages to send, fanout counts one per sender')
+parser.add_argument('--fanout', type=int, default=10, help='recipients per message with --pattern fanout')
+parser.add_argument('--rate', type=float, default=5000, help='messages per second, 0 sends as fast as possible')
+parser.add_argument('--size', type=int, default=64, help='message body size in bytes')
+parser.add_argument('--warmup', type=float, default=0.1, help='fraction of the messages left out of the results')
+parser.add_argument('--settle', type=float, default=1.0, help='seconds between connecting and sending')
+parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for messages after the last send')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--no-spawn', action='store_true', help='use nodes that are already running')
+parser.add_argument('--server-args', default='',
+                    help='options passed to every s.py node, e.g. --server-args="--engine asyncio" (the = is needed, '
+                         'the value starts with --). options after a lone -- are passed on too')
+parser.add_argument('--output', help='write the json result to this file too')
+parser.add_argument('--baseline', help='a previous json result to compare against')
+# options after a lone -- go to every node as they are: bench.py --nodes 3 -- --compress
+argv = sys.argv[1:]
+split = argv.index('--') if '--' in argv else len(argv)
+args = parser.parse_args(argv[:split])
+args.server_args = ' '.join([args.server_args, *argv[split + 1:]]).strip()
+
+if args.pattern == 'local' and args.clients < 2 * args.nodes:
+    parser.error('--pattern local needs at least two clients per node')
+if args.pattern == 'cross' and args.nodes < 2:
+    parser.error('--pattern cross needs at least two nodes')
+if args.pattern == 'fanout' and args.fanout >= args.clients:
+    parser.error('--fanout must be smaller than --clients')
+
+raise_file_limit()
+mesh = [] if args.no_spawn else start_mesh(args.nodes, args.server_args.split())
+try:
+    # give the nodes a moment to link up
+    time.sleep(0 if args.no_spawn else 0.5)
+    result = asyncio.run(run(args))
+finally:
+    stop_mesh(mesh)
+
+if args.baseline:
+    with open(args.baseline) as baseline:
+        result['compared_to_baseline'] = compare(result, json.load(baseline))
+
+output = json.dumps(result, indent=2)
+print(output)
+if args.output:
+    with open(args.output, 'w') as file:
+        file.write(output + '\n')
@@ -1,14 +1,16 @@
-import socket, sys, threading
-import shared
+import re, socket, sys, threading, time
+import compress, shared
 
 def await_messages(server_sock: socket.socket):
+    streams = {}  # (sender, stream id) -> file receiving the stream
+
     while True:
         response = shared.receive_via_socket(server_sock)
 
         # if caught any errors
         if response['error'] is not None:
-            # check if it was caused due to the connection closing
-            if isinstance(response['error'], ConnectionResetError):
+            # check if it was caused due to the connection closing, or timing out
+            if isinstance(response['error'], OSError):
                 # close the socket, and end the thread
                 server_sock.close()
                 shared.LOG_MESSAGE('connection with server has been closed.')
@@ -16,14 +18,109 @@ def await_messages(server_sock: socket.socket):
             # otherwise continue
             continue
         
+        # the server's metrics, possibly over several frames
+        if response['type'] == 6:
+            print(response['bytes_data'].decode(), end='' if response['sub_len'] & shared._LIST_MORE else '\n')
+            continue
+
+        # the server checks that we're alive while we're quiet
+        if response['type'] == 7:
+            if response['sub_type'] == shared._HEARTBEAT_PING:
+                shared.send_heartbeat(server_sock, shared._HEARTBEAT_PONG)
+            continue
+
+        # answers to our echo probes
+        if response['type'] == 4:
+            receive_probe(response)
+            continue
+
+        # the codecs the server decodes, in answer to our offer
+        if response['type'] == 9:
+            compress.compression.accept(server_sock, response['bytes_data'] or b'', response['sub_len'])
+            continue
+
+        # publishes to the channels we joined
+        if response['type'] == 8:
+            sender, channel, message = response['data'].split('\0', 2)
+            print(f'{sender} -> #{channel}: {message}')
+            continue
+
         # ignore any protocol messages that aren't direct messages
         if response['type'] != 3:
             continue
 
+        # write streamed chunks to a file as they arrive
+        if response['sub_type'] & shared._MESSAGE_STREAM:
+            receive_stream_chunk(streams, response)
+            continue
+
         # unpack message
         sender, recipient, message = response['data'].split('\0', 2)
         print(f'{sender} -> {recipient}: {message}')
 
+def receive_stream_chunk(streams: dict, response: dict) -> None:
+    sender, recipient, stream_id, flags, data = shared.unpack_stream_chunk(
+        memoryview(response['bytes_data']), response['sub_len'])
+
+    key = (sender, stream_id)
+    try:
+        if flags & shared._STREAM_FIRST:
+            # the sender's name comes off the wire, keep it to one plain file name
+            name = re.sub(r'[^\w.-]', '_', sender)
+            streams[key] = open(f'{name}-{stream_id:08x}.bin', 'wb')
+        if key not in streams:
+            return
+        streams[key].write(data)
+    except OSError as err:
+        shared.LOG_ERROR(f'could not save the file {sender} sent.\n\t{err}')
+        stream = streams.pop(key, None)
+        if stream is not None:
+            stream.close()
+        return
+
+    if flags & shared._STREAM_LAST:
+        stream = streams.pop(key)
+        stream.close()
+        print(f'{sender} -> {recipient}: sent a file, saved as {stream.name}')
+
+# echo probes, the replies of the current run
+_PROBE_TIMEOUT = 1.0  # seconds to wait for replies after the last probe
+probe_rtts  = {}  # sequence number -> (round trip time in ns, servers passed)
+probe_count = 0
+probe_done  = threading.Event()
+
+def receive_probe(response: dict) -> None:
+    seq, sent_ns, hops, target = shared.unpack_probe(memoryview(response['bytes_data']), response['sub_len'])
+    if response['sub_type'] == shared._PROBE_UNREACHABLE:
+        shared.LOG_ERROR(f'probe {seq}: {target} is not connected to our server.')
+        return
+
+    probe_rtts[seq] = (time.perf_counter_ns() - sent_ns, hops)
+    if len(probe_rtts) >= probe_count:
+        probe_done.set()
+
+def run_probes(count: int, interval: float, target: str) -> None:
+    # send the probes interval seconds apart without waiting for the replies,
+    # any number of them can be in flight
+    global probe_count
+
+    probe_rtts.clear()
+    probe_done.clear()
+    probe_count = count
+    for seq in range(count):
+        shared.send_probe(server_sock, seq, target)
+        time.sleep(interval)
+    probe_done.wait(_PROBE_TIMEOUT)
+
+    rtts = [probe_rtts[seq][0] for seq in sorted(probe_rtts)]
+    hops = max((hops for _, hops in probe_rtts.values()), default=0)
+    summary = shared.probe_summary(rtts, count)
+    shared.LOG_MESSAGE(f'{summary["sent"]} probes to {target or "our server"}, {summary["received"]} answered '
+                       + f'({summary["loss"]:.1%} loss), {hops + 1} hops.')
+    if rtts:
+        shared.LOG_MESSAGE('rtt min/avg/max/jitter = ' + '/'.join(f'{summary[key]:.3f}' for key in ('min_ms', 'avg_ms', 'max_ms', 'jitter_ms'))
+                           + ' ms, p50/p90/p99 = ' + '/'.join(f'{summary[key]:.3f}' for key in ('p50_ms', 'p90_ms', 'p99_ms')) + ' ms')
+
 # port selection
 port_index = shared.port_select(shared._PORTS)
 
@@ -33,17 +130,58 @@ if server_sock is None:
     shared.LOG_MESSAGE('Closing client...')
     input('press any key to exit.')
     exit()
+shared.set_keepalive(server_sock)
 
 # send username to the server
 username = input('Enter your name: ')
 shared.set_username(server_sock, username, True)
 
+# offer compression, the server answers if it compresses too
+compress.compression.configure()
+shared.send_offer(server_sock, shared._COMPRESS_OFFER)
+
 # create listener for the server
 server_listener = threading.Thread(target=await_messages, args=(server_sock,))
 server_listener.start()
 
-# get user input and send via server
+# get user input and send via server, '/file <recipient> <path>' streams a file,
+# '/ping [count] [interval ms] [server port]' probes our server, or another one through it,
+# '/stats' prints the server's metrics, '/join <channel>' and '/leave <channel>' change
+# subscriptions and '#<channel> <message>' publishes to a channel
 for line in sys.stdin:
+    if line.startswith(('/join ', '/leave ')):
+        command, channel = line.split()[:2]
+        sub_type = shared._CHANNEL_SUBSCRIBE if command == '/join' else shared._CHANNEL_UNSUBSCRIBE
+        shared.send_channel(server_sock, sub_type, channel.lstrip('#'))
+        continue
+
+    if line.startswith('#'):
+        channel, message = line[1:].strip().split(' ', 1)
+        shared.send_publish(server_sock, username, channel, message)
+        continue
+
+    if line.startswith('/stats'):
+        shared.send_via_socket(server_sock, shared.pack_header(6, 0, 0, 0))
+        continue
+
+    if line.startswith('/ping'):
+        options = line.split()[1:4]
+        count    = int(options[0]) if len(options) > 0 else 10
+        interval = float(options[1]) / 1000 if len(options) > 1 else 0.1
+        target   = f'{shared._LOCALHOST}:{options[2]}' if len(options) > 2 else ''
+        run_probes(count, interval, target)
+        continue
+
+    if line.startswith('/file '):
+        _, recipient, path = line.strip().split(' ', 2)
+        try:
+            with open(path, 'rb') as source:
+                sent = shared.send_stream(server_sock, username, recipient, source)
+            shared.LOG_MESSAGE(f'sent {path} ({sent} bytes) to {recipient}.')
+        except OSError as err:
+            shared.LOG_ERROR(f'could not send {path}.\n\t{err}')
+        continue
+
     recipient, message = line.strip().split(' ', 1)
     shared.send_message(server_sock, username, recipient, message)
 
@@ -0,0 +1,85 @@
+import collections, threading, time
+
+# defaults for cached recipient locations
+_CACHE_SIZE = 4096
+_CACHE_TTL  = 30.0  # seconds
+
+class LocationCache:
+    # a bounded recipient -> location map. the least recently used entries are evicted
+    # first, and entries expire ttl seconds after they were learned.
+    #
+    # locations are hints, a miss or a stale hit falls back to locating the recipient
+    # again, and the stale entry is invalidated by whoever noticed it.
+    def __init__(self, size: int = _CACHE_SIZE, ttl: float = _CACHE_TTL) -> None:
+        self.size    = size
+        self.ttl     = ttl
+        self.entries = collections.OrderedDict()  # key -> (location, expiry time)
+        self.lock    = threading.Lock()
+
+        # counters
+        self.hits          = 0
+        self.misses        = 0
+        self.expired       = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            location, expires = entry
+            if time.monotonic() >= expires:
+                del self.entries[key]
+                self.expired += 1
+                self.misses  += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return location
+
+    def put(self, key: str, location) -> None:
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (location, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: str, location=None) -> bool:
+        # forget the key, if given only while it still points at location
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (location is not None and entry[0] != location):
+                return False
+            del self.entries[key]
+            self.invalidations += 1
+            return True
+
+    def invalidate_location(self, location) -> int:
+        # forget every key pointing at location, when it went away
+        with self.lock:
+            keys = [key for key, (entry_location, _) in self.entries.items() if entry_location == location]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':       len(self.entries),
+                'capacity':      self.size,
+                'hits':          self.hits,
+                'misses':        self.misses,
+                'hit_ratio':     self.hits / lookups if lookups else 0.0,
+                'expired':       self.expired,
+                'evictions':     self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,118 @@
+import time, zlib
+import metrics
+
+# defaults
+_THRESHOLD = 128  # payload bytes below which frames are sent as they are
+_LEVEL     = 6
+_WBITS     = -15  # raw deflate, the frame header already says what the payload is
+_MAX_SIZE  = 0xFFFF
+
+# codecs a connection offers to decode
+DEFLATE    = 1
+DICTIONARY = 2  # deflate with the preset dictionary, offered along with its id
+
+# the preset dictionary for chat text: words and protocol bytes that show up in most
+# messages, the most common last where deflate reaches them with the shortest distances
+CHAT_DICTIONARY = (
+    b'\0#general\0#random\0/join /leave /file /ping /stats '
+    b'thanks thank you please sorry okay ok yes no maybe sure great good nice cool '
+    b'what when where which who why how can you could would should will did does do '
+    b'have has had been this that these those there their they them then than '
+    b'about after again also back because before being between both could down each '
+    b'first from here into just know like look make more most much need new now only '
+    b'other over people really right same see some still such take tell think time '
+    b'today tomorrow tonight morning meeting later soon around with without your '
+    b'hello hey hi bye see you later lol haha :) :( ... ?? !! '
+    b' the and for are but not all any was one our out get got it\'s i\'m don\'t '
+    b'\0server\0client\0'
+)
+
+class Compression:
+    # compression negotiated per connection. both ends offer the codecs they can decode
+    # and each one compresses what it sends with the best codec the other end offered.
+    # payloads are compressed one frame at a time, so a frame can still be dropped or
+    # shared between queues. the last payload compressed is remembered, a broadcast is
+    # compressed once for all the connections using the same codec
+    def __init__(self) -> None:
+        self.enabled       = False
+        self.threshold     = _THRESHOLD
+        self.level         = _LEVEL
+        self.dictionary    = b''
+        self.dictionary_id = 0
+        self.peers         = {}  # connection -> whether it decodes with the dictionary
+        self.last          = (None, None, None)  # payload, dictionary used, compressed payload
+
+    def configure(self, enabled: bool = True, threshold: int = _THRESHOLD, level: int = _LEVEL,
+                  dictionary: bytes = CHAT_DICTIONARY) -> None:
+        self.enabled       = enabled
+        self.threshold     = threshold
+        self.level         = level
+        self.dictionary    = dictionary
+        self.dictionary_id = zlib.crc32(dictionary) & 0xFFFF if dictionary else 0
+
+    # negotiation
+    def codecs(self) -> bytes:
+        return bytes((DICTIONARY, DEFLATE)) if self.dictionary else bytes((DEFLATE,))
+
+    def accept(self, conn, codecs: bytes, dictionary_id: int) -> None:
+        # the codecs conn decodes, the dictionary only when both ends have the same one
+        if not self.enabled:
+            return
+        if DICTIONARY in codecs and self.dictionary and dictionary_id == self.dictionary_id:
+            self.peers[conn] = True
+        elif DEFLATE in codecs:
+            self.peers[conn] = False
+
+    def forget(self, conn) -> None:
+        self.peers.pop(conn, None)
+
+    # payloads
+    def deflate(self, conn, payload, key=None):
+        # (compressed payload, dictionary used) for conn, or None to send the payload as it
+        # is. key identifies the payload for the memo, the payload itself by default
+        dictionary = self.peers.get(conn)
+        if dictionary is None or len(payload) < self.threshold:
+            return None
+
+        key = payload if key is None else key
+        last_key, last_dictionary, compressed = self.last
+        if last_key is not key or last_dictionary != dictionary:
+            started = time.thread_time()
+            if dictionary:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS, zdict=self.dictionary)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS)
+            compressed = compressor.compress(payload) + compressor.flush()
+            metrics.compression_seconds.observe(time.thread_time() - started, 'compress')
+            if len(compressed) >= len(payload):
+                compressed = None
+            self.last = (key, dictionary, compressed)
+
+        if compressed is None:
+            metrics.compression_skipped.inc()
+            return None
+        metrics.compression_raw.inc('sent', len(payload))
+        metrics.compression_wire.inc('sent', len(compressed))
+        return compressed, dictionary
+
+    def inflate(self, payload, dictionary: bool) -> bytes:
+        # raises ValueError for anything that isn't a whole compressed payload of a frame
+        if dictionary and not self.dictionary:
+            raise ValueError('compressed with a preset dictionary, but none is configured')
+        started = time.thread_time()
+        try:
+            if dictionary:
+                decompressor = zlib.decompressobj(_WBITS, zdict=self.dictionary)
+            else:
+                decompressor = zlib.decompressobj(_WBITS)
+            data = decompressor.decompress(payload, _MAX_SIZE + 1)
+        except zlib.error as err:
+            raise ValueError(err) from None
+        if len(data) > _MAX_SIZE or not decompressor.eof:
+            raise ValueError('the payload is too big, or cut short')
+        metrics.compression_seconds.observe(time.thread_time() - started, 'decompress')
+        metrics.compression_raw.inc('received', len(data))
+        metrics.compression_wire.inc('received', len(payload))
+        return data
+
+compression = Compression()
@@ -0,0 +1,37 @@
+import bisect, hashlib
+
+# virtual nodes per server, spreads each server's share evenly around the ring
+_VIRTUAL_NODES = 64
+
+# how long messages wait for a lookup answer before falling back to flooding
+_LOOKUP_TIMEOUT = 2.0
+
+def key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+def node_id(addr: tuple[str, int]) -> str:
+    return f'{addr[0]}:{addr[1]}'
+
+def parse_node_id(data: str) -> tuple[str, int]:
+    ip, port = data.rsplit(':', 1)
+    return (ip, int(port))
+
+class HashRing:
+    # consistent hash ring over server addresses. a username's location record lives
+    # on the server owning the first point at or after its hash, so adding or removing
+    # a server only moves the records in its arcs of the ring.
+    #
+    # rings are immutable, a membership change builds a new one and swaps it in,
+    # so lookups never need a lock.
+    def __init__(self, nodes: list[tuple[str, int]] = (), virtual_nodes: int = _VIRTUAL_NODES) -> None:
+        self.nodes  = frozenset(nodes)
+        ring = sorted((key_hash(f'{node_id(node)}#{i}'), node)
+                      for node in self.nodes for i in range(virtual_nodes))
+        self.points = [point for point, _ in ring]
+        self.owners = [node for _, node in ring]
+
+    def owner(self, key: str) -> tuple[str, int]:
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.points, key_hash(key))
+        return self.owners[index % len(self.owners)]
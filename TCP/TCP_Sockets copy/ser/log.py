@@ -0,0 +1,165 @@
+import atexit, collections, json, os, sys, threading, time
+
+# levels
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+LEVELS  = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+_NAMES  = {level: name.upper() for name, level in LEVELS.items()}
+
+# records waiting for the writer, beyond that the oldest are dropped
+_RING_SIZE      = 8192
+_FLUSH_INTERVAL = 0.05  # seconds between writes, errors are written right away
+
+# ANSI colours, used when writing to a terminal
+_COLOURS = {DEBUG: '\033[94m', INFO: '\033[93m', WARNING: '\033[95m', ERROR: '\033[91m'}
+_RESET   = '\033[0m'
+
+class Logger:
+    # callers only append a record to a ring buffer, a writer thread formats and writes
+    # them in batches. per message events (one per forwarded message) go through
+    # message(), which can be turned off, sampled and rate limited before anything
+    # is built. counters are approximate under threads, they're only statistics.
+    def __init__(self, ring_size: int = _RING_SIZE, stream=None) -> None:
+        self.level       = INFO
+        self.per_message = True
+        self.sample      = 1    # log one of every sample per message events
+        self.rate        = 0.0  # per message events per second, 0 for no limit
+        self.json        = False
+        self.stream      = stream or sys.stdout
+        self.records     = collections.deque(maxlen=ring_size)
+        self.wakeup      = threading.Event()
+        self.drain_lock  = threading.Lock()
+        self.writer      = None
+        self.start_lock  = threading.Lock()
+
+        # per message sampling and rate limiting state
+        self.seen     = 0
+        self.tokens   = 0.0
+        self.refilled = time.monotonic()
+
+        # counters
+        self.dropped      = 0
+        self.sampled_out  = 0
+        self.rate_limited = 0
+        self.reported     = 0  # drops already reported in the log
+
+        atexit.register(self.flush)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, level: str = 'info', per_message: bool = True, sample: int = 1,
+                  rate: float = 0.0, json_format: bool = False, ring_size: int = None) -> None:
+        self.level       = LEVELS[level]
+        self.per_message = per_message
+        self.sample      = max(1, sample)
+        self.rate        = rate
+        self.tokens      = rate
+        self.json        = json_format
+        if ring_size is not None:
+            self.records = collections.deque(self.records, maxlen=ring_size)
+
+    # logging
+    def log(self, level: int, message: str, **fields) -> None:
+        if level >= self.level:
+            self._push(level, message, fields)
+
+    def debug(self, message: str, **fields) -> None:
+        self.log(DEBUG, message, **fields)
+
+    def info(self, message: str, **fields) -> None:
+        self.log(INFO, message, **fields)
+
+    def warning(self, message: str, **fields) -> None:
+        self.log(WARNING, message, **fields)
+
+    def error(self, message: str, **fields) -> None:
+        self.log(ERROR, message, **fields)
+
+    def message(self, event: str, **fields) -> None:
+        # a per message event, the checks come first so a skipped event costs next to nothing
+        if not self.per_message or INFO < self.level:
+            return
+
+        self.seen += 1
+        if self.seen % self.sample:
+            self.sampled_out += 1
+            return
+
+        if self.rate > 0:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.rate_limited += 1
+                return
+            self.tokens -= 1
+
+        self._push(INFO, event, fields)
+
+    def stats(self) -> dict:
+        return {'dropped': self.dropped, 'sampled_out': self.sampled_out, 'rate_limited': self.rate_limited}
+
+    # writing
+    def _push(self, level: int, message: str, fields: dict) -> None:
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), level, message, fields))
+
+        if self.writer is None:
+            self._start()
+        if level >= ERROR:
+            self.wakeup.set()
+
+    def _start(self) -> None:
+        with self.start_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write, daemon=True)
+                self.writer.start()
+
+    def _write(self) -> None:
+        while True:
+            self.wakeup.wait(_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+
+    def _after_fork(self) -> None:
+        # the writer thread stays behind in the parent, which also writes what was buffered
+        self.records.clear()
+        self.wakeup     = threading.Event()
+        self.drain_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.writer     = None
+
+    def flush(self) -> None:
+        # write everything buffered so far
+        with self.drain_lock:
+            lines = []
+            while self.records:
+                lines.append(self._format(*self.records.popleft()))
+            if self.dropped != self.reported:
+                lines.append(self._format(time.time(), WARNING, 'log buffer overflowed, records were dropped',
+                                          {'dropped': self.dropped - self.reported}))
+                self.reported = self.dropped
+            if not lines:
+                return
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def _format(self, timestamp: float, level: int, message: str, fields: dict) -> str:
+        if self.json:
+            return json.dumps({'time': round(timestamp, 6), 'level': _NAMES[level].lower(),
+                               'message': message, **fields}, default=str) + '\n'
+
+        text = f'{_NAMES[level]}: {message}'
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        if self.stream.isatty():
+            text = f'{_COLOURS[level]}{text}{_RESET}'
+        return text + '\n'
+
+logger = Logger()
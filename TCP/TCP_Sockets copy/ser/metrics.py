@@ -0,0 +1,172 @@
+import bisect, threading
+
+# histogram buckets, latencies in seconds and counts such as broadcast fan-out
+_LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+_COUNT_BUCKETS   = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+_FOLD_MIN        = 64  # shards registered before the ones of finished threads are folded
+
+class _Sharded:
+    # values are kept per thread and merged when scraped, so recording never takes a lock.
+    # the shards of finished threads are folded into one when a scrape comes, and when
+    # the shards doubled since the last fold, so they stay within twice the live threads
+    # and registering a thread costs the same however many there are
+    def __init__(self, name: str, help: str, label: str = None) -> None:
+        self.name    = name
+        self.help    = help
+        self.label   = label
+        self.local   = threading.local()
+        self.shards  = []  # (thread, shard)
+        self.folded  = {}
+        self.fold_at = _FOLD_MIN  # shards at which the next registration folds
+        self.lock    = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                if len(self.shards) >= self.fold_at:
+                    self._fold()
+            return shard
+
+    def _fold(self) -> None:
+        # called with the lock held
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge(self.folded, shard)
+        self.shards = live
+        self.fold_at = max(_FOLD_MIN, 2 * len(live))
+
+    def _collect(self) -> dict:
+        with self.lock:
+            self._fold()
+            merged = {}
+            self._merge(merged, self.folded)
+            for _, shard in self.shards:
+                self._merge(merged, shard.copy())
+            return merged
+
+    def _labels(self, value, extra: str = '') -> str:
+        labels = [f'{self.label}="{value}"'] if self.label else []
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+class Counter(_Sharded):
+    kind = 'counter'
+
+    def inc(self, value=None, amount: int = 1) -> None:
+        shard = self._shard()
+        shard[value] = shard.get(value, 0) + amount
+
+    def _merge(self, into: dict, shard: dict) -> None:
+        for value, count in shard.items():
+            into[value] = into.get(value, 0) + count
+
+    def render(self) -> list[str]:
+        return [f'{self.name}{self._labels(value)} {count}' for value, count in sorted(self._collect().items(), key=str)]
+
+class Histogram(_Sharded):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: tuple, label: str = None) -> None:
+        super().__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, amount: float, value=None) -> None:
+        shard = self._shard()
+        entry = shard.get(value)
+        if entry is None:
+            entry = shard[value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, amount)] += 1
+        entry[1] += amount
+        entry[2] += 1
+
+    def _merge(self, into: dict, shard: dict) -> None:
+        for value, (counts, total, count) in shard.items():
+            entry = into.setdefault(value, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+            entry[2] += count
+
+    def render(self) -> list[str]:
+        lines = []
+        for value, (counts, total, count) in sorted(self._collect().items(), key=str):
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._labels(value, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(value)} {total}')
+            lines.append(f'{self.name}_count{self._labels(value)} {count}')
+        return lines
+
+class Gauge:
+    # a value computed only when scraped. the callback returns a number, or a dict of
+    # label value -> number
+    def __init__(self, name: str, help: str, callback, label: str = None, kind: str = 'gauge') -> None:
+        self.name     = name
+        self.help     = help
+        self.callback = callback
+        self.label    = label
+        self.kind     = kind
+
+    def render(self) -> list[str]:
+        values = self.callback()
+        if not isinstance(values, dict):
+            return [f'{self.name} {values}']
+        return [f'{self.name}{{{self.label}="{value}"}} {number}' for value, number in sorted(values.items(), key=str)]
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def counter(self, name: str, help: str, label: str = None) -> Counter:
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name: str, help: str, buckets: tuple = _LATENCY_BUCKETS, label: str = None) -> Histogram:
+        return self._add(Histogram(name, help, buckets, label))
+
+    def gauge(self, name: str, help: str, callback, label: str = None, kind: str = 'gauge') -> Gauge:
+        return self._add(Gauge(name, help, callback, label, kind))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# protocol metrics, recorded by shared and the server
+frames_in       = registry.counter('chat_frames_received_total', 'Frames received, by protocol type.', 'type')
+bytes_in        = registry.counter('chat_bytes_received_total', 'Bytes received including headers, after decompression, by protocol type.', 'type')
+frames_out      = registry.counter('chat_frames_sent_total', 'Frames sent or queued, by protocol type.', 'type')
+bytes_out       = registry.counter('chat_bytes_sent_total', 'Bytes sent or queued including headers, before compression, by protocol type.', 'type')
+forward_latency = registry.histogram('chat_forward_seconds', 'Time from receiving a message to handing it to its next hop.')
+reaped          = registry.counter('chat_connections_reaped_total', 'Connections closed for being idle, by role.', 'role')
+fanout          = registry.histogram('chat_broadcast_fanout', 'Connections a broadcast frame was sent to.',
+                                     _COUNT_BUCKETS, 'kind')
+
+# compression, recorded by compress
+compression_raw     = registry.counter('chat_compression_raw_bytes_total',
+                                       'Payload bytes of compressed frames before compression, by direction.', 'direction')
+compression_wire    = registry.counter('chat_compression_wire_bytes_total',
+                                       'Payload bytes of compressed frames as sent over the wire, by direction.', 'direction')
+compression_skipped = registry.counter('chat_compression_skipped_total',
+                                       'Frames over the threshold sent uncompressed, compressing did not make them smaller.')
+compression_seconds = registry.histogram('chat_compression_seconds',
+                                         'CPU time spent compressing or decompressing one payload.', label='operation')
@@ -0,0 +1,417 @@
+import asyncio, collections, os, socket, threading, time
+import shared
+
+# policies for consumers that can't keep up with their outbound queue
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT  = 'disconnect'
+BLOCK       = 'block'
+POLICIES    = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+# default watermarks, in queued bytes
+_HIGH_WATERMARK = 1024 * 1024
+_LOW_WATERMARK  = 256 * 1024
+
+# write coalescing, off unless a flush interval is given
+_BATCH_INTERVAL = 0.0
+_BATCH_BYTES    = 64 * 1024
+_IOV_MAX        = 1024
+
+# stored frames at least this big are sent with os.sendfile, smaller ones go out with the
+# other queued frames in one sendmsg, as slices of the segment's mapping
+_SENDFILE_MIN = 16 * 1024
+
+class QueuedConnection:
+    # a socket wrapper owning a bounded outbound queue, drained by its own writer thread.
+    # it exposes the socket methods used by shared, so the send helpers queue instead
+    # of writing from the thread that produced the message.
+    #
+    # when a push would take the queue above the high watermark the policy applies:
+    #   block       - the producer waits until the writer drains below the low watermark
+    #   drop-oldest - the oldest queued frames are dropped to make room
+    #   disconnect  - the connection is shut down
+    #
+    # with a batch interval the writer waits up to that long (or until batch_bytes are
+    # queued) and flushes everything queued with a single sendmsg.
+    def __init__(self, sock: socket.socket, high_watermark: int = _HIGH_WATERMARK,
+                 low_watermark: int = _LOW_WATERMARK, policy: str = BLOCK,
+                 batch_interval: float = _BATCH_INTERVAL, batch_bytes: int = _BATCH_BYTES) -> None:
+        self.sock           = sock
+        self.high_watermark = high_watermark
+        self.low_watermark  = min(low_watermark, high_watermark)
+        self.policy         = policy
+        self.batch_interval = batch_interval
+        self.batch_bytes    = batch_bytes
+        self.frames         = collections.deque()
+        self.changed        = threading.Condition()
+        self.closed         = False
+
+        # counters
+        self.queued_bytes   = 0
+        self.sent_frames    = 0
+        self.sent_bytes     = 0
+        self.writes         = 0
+        self.dropped_frames = 0
+        self.dropped_bytes  = 0
+
+        self.writer = threading.Thread(target=self._drain, daemon=True)
+        self.writer.start()
+
+    # socket interface
+    def sendmsg(self, buffers: list) -> int:
+        # the frame is copied, payloads may point into a reused receive buffer. a frame that
+        # already is a single bytes object is queued as is, so every queue a broadcast
+        # frame goes to shares the one buffer
+        frame = b''.join(buffers)
+        self.push(frame)
+        return len(frame)
+
+    def sendall(self, data: bytes) -> None:
+        self.push(bytes(data))
+
+    def send(self, data: bytes) -> int:
+        self.push(bytes(data))
+        return len(data)
+
+    def replay(self, frames: list) -> None:
+        # frames still in the offline store's files are queued as they are, the writer
+        # sends them from the file
+        for frame in frames:
+            self.push(frame)
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.sock.getpeername()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self) -> None:
+        # the socket is closed even if the connection was shut down before
+        with self.changed:
+            if not self.closed:
+                self._close_locked()
+        self.sock.close()
+
+    def shutdown(self) -> None:
+        # end the connection from any thread, its reader then closes and unregisters it
+        with self.changed:
+            self._close_locked()
+
+    # queue
+    def full(self, size: int) -> bool:
+        # whether pushing size bytes would apply the policy, for senders that mustn't wait
+        with self.changed:
+            return bool(self.frames) and self.queued_bytes + size > self.high_watermark
+
+    def push(self, frame: bytes) -> None:
+        size = len(frame)
+        with self.changed:
+            if self.closed:
+                raise ConnectionAbortedError('connection is closed')
+
+            if self.frames and self.queued_bytes + size > self.high_watermark:
+                if self.policy == BLOCK:
+                    # pause the producer until the writer catches up
+                    while not self.closed and self.queued_bytes > self.low_watermark:
+                        self.changed.wait()
+                    if self.closed:
+                        raise ConnectionAbortedError('connection is closed')
+                elif self.policy == DROP_OLDEST:
+                    while self.frames and self.queued_bytes + size > self.high_watermark:
+                        self._drop(self.frames.popleft())
+                else:
+                    self._drop(frame, queued=False)
+                    self._close_locked()
+                    raise ConnectionAbortedError('outbound queue overflowed, disconnecting')
+
+            self.frames.append(frame)
+            self.queued_bytes += size
+            self.changed.notify_all()
+
+    def stats(self) -> dict:
+        with self.changed:
+            return {
+                'queued_frames':    len(self.frames),
+                'queued_bytes':     self.queued_bytes,
+                'sent_frames':      self.sent_frames,
+                'sent_bytes':       self.sent_bytes,
+                'writes':           self.writes,
+                'frames_per_write': self.sent_frames / self.writes if self.writes else 0.0,
+                'dropped_frames':   self.dropped_frames,
+                'dropped_bytes':    self.dropped_bytes,
+            }
+
+    def _drop(self, frame: bytes, queued: bool = True) -> None:
+        if queued:
+            self.queued_bytes -= len(frame)
+        self.dropped_frames += 1
+        self.dropped_bytes  += len(frame)
+
+    def _close_locked(self) -> None:
+        # wake up the writer and any blocked producers, and unblock the reader
+        self.closed = True
+        self.changed.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _next_batch(self) -> list:
+        # called with the lock held and at least one frame queued. a frame sent with
+        # sendfile is a batch of its own. replayed frames were queued all at once, they're
+        # batched with each other even without a batch interval
+        if _use_sendfile(self.frames[0]):
+            return [self.frames.popleft()]
+        if self.batch_interval <= 0 and isinstance(self.frames[0], bytes):
+            return [self.frames.popleft()]
+
+        # give the producers a moment to queue more frames for the same write
+        deadline = time.monotonic() + self.batch_interval
+        while not self.closed and self.queued_bytes < self.batch_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.changed.wait(remaining)
+
+        batch = [self.frames.popleft()]
+        size = len(batch[0])
+        while self.frames and len(batch) < _IOV_MAX and size + len(self.frames[0]) <= self.batch_bytes:
+            frame = self.frames[0]
+            if _use_sendfile(frame) or (self.batch_interval <= 0 and isinstance(frame, bytes)):
+                break
+            batch.append(self.frames.popleft())
+            size += len(frame)
+        return batch
+
+    def _drain(self) -> None:
+        while True:
+            with self.changed:
+                while not self.frames and not self.closed:
+                    self.changed.wait()
+                if self.closed:
+                    return
+                batch = self._next_batch()
+
+            try:
+                if _use_sendfile(batch[0]):
+                    self._sendfile(batch[0])
+                else:
+                    shared.send_buffers(self.sock, [frame if isinstance(frame, bytes) else frame.view() for frame in batch])
+            except OSError as err:
+                if not self.closed:
+                    shared.LOG_ERROR(f'an error occurred while sending a queued message.\n\t{err}')
+                with self.changed:
+                    self._close_locked()
+                return
+
+            size = sum(len(frame) for frame in batch)
+            with self.changed:
+                self.queued_bytes -= size
+                self.sent_frames  += len(batch)
+                self.sent_bytes   += size
+                self.writes       += 1
+                if self.queued_bytes <= self.low_watermark:
+                    self.changed.notify_all()
+
+    def _sendfile(self, frame) -> None:
+        # straight from the segment file to the socket, resume after short writes
+        offset, remaining = frame.offset, frame.length
+        while remaining:
+            sent = os.sendfile(self.sock.fileno(), frame.fd, offset, remaining)
+            if not sent:
+                raise ConnectionAbortedError('stored frame was cut short')
+            offset    += sent
+            remaining -= sent
+
+class StreamConnection:
+    # asyncio counterpart of QueuedConnection, wrapping a stream writer with the socket
+    # methods used by shared. the transport write buffer is the queue, drained by the
+    # event loop, and the same policies apply above the high watermark:
+    #   block       - the connection is marked congested for the task that wrote to it,
+    #                 which awaits drain_congested() before reading its next message
+    #   drop-oldest - frames wait in a backlog until the transport drains, dropping the oldest
+    #   disconnect  - the connection is aborted
+    #
+    # with a batch interval, frames are collected and handed to the transport as one
+    # write after that long, or as soon as batch_bytes are pending.
+    congested = {}  # producer task -> connections it wrote to above their high watermark
+
+    def __init__(self, writer: asyncio.StreamWriter, high_watermark: int = _HIGH_WATERMARK,
+                 low_watermark: int = _LOW_WATERMARK, policy: str = BLOCK,
+                 batch_interval: float = _BATCH_INTERVAL, batch_bytes: int = _BATCH_BYTES) -> None:
+        self.writer         = writer
+        self.transport      = writer.transport
+        self.high_watermark = high_watermark
+        self.policy         = policy
+        self.batch_interval = batch_interval
+        self.batch_bytes    = batch_bytes
+        self.batch          = []
+        self.batch_size     = 0
+        self.batch_timer    = None
+        self.backlog        = collections.deque()
+        self.backlog_bytes  = 0
+        self.flusher        = None
+        self.transport.set_write_buffer_limits(high_watermark, min(low_watermark, high_watermark))
+
+        # counters
+        self.sent_frames    = 0
+        self.sent_bytes     = 0
+        self.writes         = 0
+        self.dropped_frames = 0
+        self.dropped_bytes  = 0
+
+    @property
+    def queued_bytes(self) -> int:
+        return self.transport.get_write_buffer_size() + self.batch_size + self.backlog_bytes
+
+    # socket interface
+    def sendmsg(self, buffers: list) -> int:
+        size = sum(len(buffer) for buffer in buffers)
+        if self.transport.is_closing():
+            raise ConnectionAbortedError('connection is closed')
+
+        queued_bytes = self.queued_bytes
+        if queued_bytes and queued_bytes + size > self.high_watermark:
+            self._flush_batch()
+            if self.policy == DISCONNECT:
+                self._drop(size)
+                self.transport.abort()
+                raise ConnectionAbortedError('outbound queue overflowed, disconnecting')
+            if self.policy == BLOCK:
+                producer = asyncio.current_task()
+                if producer is not None:
+                    StreamConnection.congested.setdefault(producer, set()).add(self)
+            elif self.policy == DROP_OLDEST:
+                self._hold(b''.join(buffers))
+                return size
+
+        # keep ordering behind frames that are still held back
+        if self.backlog:
+            self._hold(b''.join(buffers))
+            return size
+
+        if self.batch_interval > 0:
+            self._batch(buffers, size)
+            return size
+
+        self.writer.writelines(buffers)
+        self.sent_frames += 1
+        self.sent_bytes  += size
+        self.writes      += 1
+        return size
+
+    def sendall(self, data: bytes) -> None:
+        self.sendmsg([data])
+
+    def send(self, data: bytes) -> int:
+        return self.sendmsg([data])
+
+    def replay(self, frames: list) -> None:
+        # frames still in the offline store's files, written as slices of the mapping.
+        # loop.sendfile can't share the transport with other writers, so no sendfile here
+        for frame in frames:
+            self.sendmsg([frame.view()])
+
+    def getpeername(self) -> tuple[str, int]:
+        return self.writer.get_extra_info('peername')
+
+    def full(self, size: int) -> bool:
+        queued_bytes = self.queued_bytes
+        return bool(queued_bytes) and queued_bytes + size > self.high_watermark
+
+    def close(self) -> None:
+        for conns in StreamConnection.congested.values():
+            conns.discard(self)
+        self._flush_batch()
+        self.writer.close()
+
+    def shutdown(self) -> None:
+        # end the connection, its reader then closes and unregisters it. loop thread only
+        self.transport.abort()
+
+    def stats(self) -> dict:
+        return {
+            'queued_frames':    len(self.backlog) + len(self.batch),
+            'queued_bytes':     self.queued_bytes,
+            'sent_frames':      self.sent_frames,
+            'sent_bytes':       self.sent_bytes,
+            'writes':           self.writes,
+            'frames_per_write': self.sent_frames / self.writes if self.writes else 0.0,
+            'dropped_frames':   self.dropped_frames,
+            'dropped_bytes':    self.dropped_bytes,
+        }
+
+    async def drain(self) -> None:
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def _drop(self, size: int) -> None:
+        self.dropped_frames += 1
+        self.dropped_bytes  += size
+
+    def _batch(self, buffers: list, size: int) -> None:
+        # payloads handed to us are immutable bytes on this engine, keep them as they are
+        self.batch.extend(buffers)
+        self.batch_size  += size
+        self.sent_frames += 1
+        if self.batch_size >= self.batch_bytes:
+            self._flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(self.batch_interval, self._flush_batch)
+
+    def _flush_batch(self) -> None:
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if not self.batch:
+            return
+
+        self.writer.write(b''.join(self.batch))
+        self.sent_bytes += self.batch_size
+        self.writes     += 1
+        self.batch.clear()
+        self.batch_size = 0
+
+    def _hold(self, frame: bytes) -> None:
+        self.backlog.append(frame)
+        self.backlog_bytes += len(frame)
+        while len(self.backlog) > 1 and self.queued_bytes > self.high_watermark:
+            dropped = self.backlog.popleft()
+            self.backlog_bytes -= len(dropped)
+            self._drop(len(dropped))
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self._flush_backlog())
+
+    async def _flush_backlog(self) -> None:
+        # wait for the transport to drain below the low watermark, then release the backlog
+        try:
+            while self.backlog and not self.transport.is_closing():
+                await self.writer.drain()
+                while self.backlog and self.transport.get_write_buffer_size() < self.high_watermark:
+                    frame = self.backlog.popleft()
+                    self.backlog_bytes -= len(frame)
+                    self.writer.write(frame)
+                    self.sent_frames += 1
+                    self.sent_bytes  += len(frame)
+                    self.writes      += 1
+        except ConnectionError:
+            pass
+        finally:
+            self.flusher = None
+
+def _use_sendfile(frame) -> bool:
+    # whether a queued frame is a big enough stored frame to go out with os.sendfile
+    return not isinstance(frame, bytes) and frame.length >= _SENDFILE_MIN and hasattr(os, 'sendfile')
+
+def congested() -> bool:
+    # whether the current task wrote to a connection above its high watermark
+    return bool(StreamConnection.congested.get(asyncio.current_task()))
+
+async def drain_congested() -> None:
+    # called by a producer between messages, pauses its reading until the congested
+    # connections it wrote to have drained below the low watermark. producers that
+    # didn't write to them keep reading
+    for conn in StreamConnection.congested.pop(asyncio.current_task(), ()):
+        await conn.drain()
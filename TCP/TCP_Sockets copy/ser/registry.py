@@ -0,0 +1,157 @@
+import threading
+
+# connection roles
+PENDING = 'pending'  # connected, but not registered yet
+CLIENT  = 'client'
+SERVER  = 'server'
+WORKER  = 'worker'   # a sibling worker process of the same node
+
+# username shards, each behind its own lock
+_SHARDS = 16
+
+class Registry:
+    # connections of a server, indexed by connection, by username and by server address.
+    #
+    # lookups are plain dict reads and take no lock. changes lock only what they touch:
+    # client registrations lock the shard of their username, so registrations of different
+    # usernames don't contend, and connection/server changes share one lock, they're rare.
+    def __init__(self, shards: int = _SHARDS) -> None:
+        self.shards        = [({}, threading.Lock()) for _ in range(shards)]
+        self.roles         = {}  # connection -> (role, username or server address)
+        self.servers       = {}  # server address -> connection
+        self.workers       = {}  # worker index -> connection
+        self.pending       = set()
+        self.lock          = threading.Lock()
+
+    def _shard(self, username: str) -> tuple[dict, threading.Lock]:
+        return self.shards[hash(username) % len(self.shards)]
+
+    # registration
+    def add_pending(self, conn) -> None:
+        with self.lock:
+            self.pending.add(conn)
+            self.roles[conn] = (PENDING, None)
+
+    def claim_client(self, username: str, conn) -> bool:
+        # register the connection under username, unless the username is taken
+        clients, lock = self._shard(username)
+        with lock:
+            if username in clients:
+                return False
+            clients[username] = conn
+
+        with self.lock:
+            self.pending.discard(conn)
+            self.roles[conn] = (CLIENT, username)
+        return True
+
+    def add_server(self, addr: tuple[str, int], conn) -> None:
+        # a newer connection to the same server replaces the previous one
+        with self.lock:
+            previous = self.servers.get(addr)
+            if previous is not None and previous is not conn:
+                self.roles.pop(previous, None)
+            self.pending.discard(conn)
+            self.servers[addr] = conn
+            self.roles[conn] = (SERVER, addr)
+
+    def add_worker(self, index: int, conn) -> None:
+        with self.lock:
+            previous = self.workers.get(index)
+            if previous is not None and previous is not conn:
+                self.roles.pop(previous, None)
+            self.pending.discard(conn)
+            self.workers[index] = conn
+            self.roles[conn] = (WORKER, index)
+
+    def remove(self, conn) -> tuple[str, object]:
+        # forget the connection, returns its role and username, server address or worker index
+        with self.lock:
+            self.pending.discard(conn)
+            role, key = self.roles.pop(conn, (None, None))
+            if role == SERVER and self.servers.get(key) is conn:
+                del self.servers[key]
+            elif role == WORKER and self.workers.get(key) is conn:
+                del self.workers[key]
+
+        if role == CLIENT:
+            clients, lock = self._shard(key)
+            with lock:
+                if clients.get(key) is conn:
+                    del clients[key]
+        return role, key
+
+    # lookups
+    def role(self, conn) -> str:
+        return self.roles.get(conn, (None, None))[0]
+
+    def is_server(self, conn) -> bool:
+        return self.role(conn) == SERVER
+
+    def server_address(self, conn) -> tuple[str, int]:
+        role, key = self.roles.get(conn, (None, None))
+        return key if role == SERVER else None
+
+    def is_worker(self, conn) -> bool:
+        return self.role(conn) == WORKER
+
+    def worker_index(self, conn) -> int:
+        role, key = self.roles.get(conn, (None, None))
+        return key if role == WORKER else None
+
+    def client(self, username: str):
+        return self._shard(username)[0].get(username)
+
+    def server(self, addr: tuple[str, int]):
+        return self.servers.get(addr)
+
+    def worker(self, index: int):
+        return self.workers.get(index)
+
+    def has_client(self, username: str) -> bool:
+        return username in self._shard(username)[0]
+
+    def has_server(self, addr: tuple[str, int]) -> bool:
+        return addr in self.servers
+
+    # snapshots, safe to iterate while connections come and go
+    def connections(self) -> list:
+        with self.lock:
+            return list(self.roles)
+
+    def role_counts(self) -> dict:
+        with self.lock:
+            counts = {PENDING: 0, CLIENT: 0, SERVER: 0, WORKER: 0}
+            for role, _ in self.roles.values():
+                counts[role] += 1
+            return counts
+
+    def client_items(self) -> list[tuple[str, object]]:
+        items = []
+        for clients, lock in self.shards:
+            with lock:
+                items.extend(clients.items())
+        return items
+
+    def client_names(self) -> list[str]:
+        return [username for username, _ in self.client_items()]
+
+    def client_connections(self) -> list:
+        return [conn for _, conn in self.client_items()]
+
+    def server_items(self) -> list[tuple[tuple[str, int], object]]:
+        with self.lock:
+            return list(self.servers.items())
+
+    def server_addresses(self) -> list[tuple[str, int]]:
+        return [addr for addr, _ in self.server_items()]
+
+    def server_connections(self) -> list:
+        return [conn for _, conn in self.server_items()]
+
+    def worker_items(self) -> list[tuple[int, object]]:
+        with self.lock:
+            return list(self.workers.items())
+
+    def worker_connections(self) -> list:
+        return [conn for _, conn in self.worker_items()]
@@ -1,193 +1,1122 @@
-import socket, threading
-import shared
+import argparse, asyncio, os, socket, struct, threading, time
+import cache, compress, directory, log, metrics, outbound, registry, shared, store
 
-def setup_listener(port: int) -> socket.socket:
+def setup_listener(port: int, reuse_port: bool = False) -> socket.socket:
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
     listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker listens on the same port, the kernel spreads the connections between them
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     listener.bind(('0.0.0.0', port))
-    listener.listen(1)
+    listener.listen(socket.SOMAXCONN)
     return listener
 
 def await_connections(listener: socket.socket) -> None:
-    global temp
     shared.LOG_MESSAGE('awaiting for connections...')
     while True:
         conn_socket, conn_address = listener.accept()
-        temp.append(conn_socket)
+        tune_socket(conn_socket)
+        conn = queue_connection(conn_socket)
+        connections.add_pending(conn)
         shared.LOG_MESSAGE(f'connection with {conn_address} established.')
-        threading.Thread(target=respond_to_connection, args=(conn_socket, conn_address)).start()
+        threading.Thread(target=respond_to_connection, args=(conn, conn_address)).start()
 
-def respond_to_connection(conn_socket: socket.socket, conn_address: tuple[str, int]) -> None:
-    global clients, servers, temp
+def tune_socket(sock: socket.socket) -> None:
+    shared.set_nodelay(sock, args.nodelay)
+    if args.keepalive_idle > 0:
+        shared.set_keepalive(sock, args.keepalive_idle, args.keepalive_interval, args.keepalive_count)
 
+def queue_connection(sock: socket.socket) -> outbound.QueuedConnection:
+    # writes to the connection go through its own bounded queue and writer thread
+    return outbound.QueuedConnection(sock, args.queue_high, args.queue_low, args.queue_policy,
+                                     args.batch_interval / 1e6, args.batch_bytes)
+
+def respond_to_connection(conn_socket: outbound.QueuedConnection, conn_address: tuple[str, int]) -> None:
     if conn_socket is None:
         shared.LOG_ERROR(f'cant respond to connection {conn_address=}  {conn_socket=}')
         return
 
-    while True:
-        response = shared.receive_via_socket(conn_socket)
+    reader = shared.FrameReader(conn_socket.sock)
+    try:
+        for header, payload in reader.frames():
+            # handle the message, end the thread if the connection got closed
+            if not handle_message(conn_socket, conn_address, header, payload):
+                break
+    except OSError as err:
+        # the connection was closed or reset
+        if not isinstance(err, ConnectionResetError):
+            shared.LOG_ERROR(f'an error occurred while retrieving a message from {conn_address}.\n\t{err}')
 
-        # if caught any errors
-        if response['error'] is not None:
-            # check if it was caused due to the connection closing
-            if isinstance(response['error'], ConnectionResetError):
-                # close the socket, and end the thread
-                conn_socket.close()
-                shared.LOG_MESSAGE(f'connection with {conn_address} has been closed.')
-                return
-            # otherwise continue
-            continue
-        
-        # check if the connection is held with a server
-        conn_is_server = conn_socket in servers.values()
-
-        # received a request for a server list
-        if   response['type'] == 0 and response['sub_type'] == 0:
-            shared.LOG_MESSAGE(f'received a server list request, replying.')
-            share_servers(conn_socket)
-        # received a request for a client list
-        elif response['type'] == 0 and response['sub_type'] == 1:
-            shared.LOG_MESSAGE(f'received a client list request, replying.')
-            share_clients(conn_socket)
-        # received an answer for a server list request
-        elif response['type'] == 1 and response['sub_type'] == 0:
-            shared.LOG_MESSAGE(f'received an answer for a server list request,'
-                               + '\n\tbut it was not requested.'
-                               + f'\n\tsender {conn_address}.')
-            continue  # unused functionality
-        # received an answer for a client list request
-        elif response['type'] == 1 and response['sub_type'] == 1:
-            shared.LOG_MESSAGE(f'received an answer for a client list request,'
-                               + '\n\tbut it was not requested.'
-                               + f'\n\tsender {conn_address}.')
-            continue  # unused functionality
-        # received a request for setting a server username
-        elif response['type'] == 2 and response['sub_type'] == 0:
-            shared.LOG_MESSAGE(f'received a request for registering a server.'
-                               + f'\n\tsender {conn_address}.')
-            # remove server from temp list
-            try:
-                temp.remove(conn_address)
-            except:
-                pass
-            
-            servers[(conn_address[0], int(response['data']))] = conn_socket
-            shared.LOG_MESSAGE(f'registered {conn_address} as server at port {response['data']}.')
-        # received a request for setting a client username
-        elif response['type'] == 2 and response['sub_type'] == 1:
-            # remove client from temp list
-            try:
-                temp.remove(conn_address)
-            except:
-                pass
+    # close the socket, forget the connection, and end the thread
+    conn_socket.close()
+    unregister_connection(conn_socket)
+    shared.LOG_MESSAGE(f'connection with {conn_address} has been closed.')
 
-            # if selected username is already taken, close connection and show an error
-            if response['data'] in clients:
-                shared.LOG_ERROR(f'requested username "{response['data']}" by {conn_address} is already taken!'
-                                 + '\n\tclosing connection...')
-                conn_socket.close()
-                return
-            
-            # otherwise register the connection under the requested username
-            clients[response['data']] = conn_socket
-            shared.LOG_MESSAGE(f'registered {conn_address} as "{response['data']}".')
-        # received a request for direct message forwarding
-        elif response['type'] == 3:
-            # unpack message
-            sender, recipient, message = response['data'].split('\0', 2)
-
-            # if a direct connection with recipient is established, forward the message directly
-            if recipient in clients:
-                shared.LOG_MESSAGE(f'forwarding message...\n\t{sender} -> {recipient}: {message}')
-                shared.send_message(clients[recipient], sender, recipient, message)
-            # if the sender is a server, drop the broadcasted message to avoid flooding
-            elif conn_is_server:
-                shared.LOG_MESSAGE(f'received a message forwarding broadcast, dropping package.')
-                continue
-            # otherwise broadcast the message to other servers
-            else:
-                shared.LOG_MESSAGE(f'broadcasting message...\n\t{sender} -> {recipient}: {message}')
-                broadcast_to_servers(response['bytes_header'], response['bytes_data'])
+def unregister_connection(conn_socket: socket.socket) -> None:
+    role, key = connections.remove(conn_socket)
+    activity.pop(conn_socket, None)
+    compress.compression.forget(conn_socket)
+
+    # a client left, let the other servers know
+    if role == registry.CLIENT:
+        unsubscribe(conn_socket, list(subscriptions.get(conn_socket, ())))
+        announce_client(key, joined=False)
+
+    # a server left, its clients are no longer reachable through it
+    elif role == registry.SERVER:
+        left = [username for username, route in list(routes.items()) if route == key]
+        for username in left:
+            routes.pop(username, None)
+        share_with_workers(1, 1, shared.encode_clients(left), shared._PRESENCE_LEAVE | shared._LIST_RELAYED)
+        share_with_workers(1, 0, shared.encode_servers([key]), shared._PRESENCE_LEAVE)
+        locations.invalidate_location(key)
+        set_interest(channel_servers, key, shared._PRESENCE_SNAPSHOT, [])
+        update_ring()
+
+    # a sibling worker left, along with its clients and the servers it was connected to
+    elif role == registry.WORKER:
+        left = drop_worker_entries(hosted, key)
+        drop_worker_entries(relays, key)
+        drop_worker_entries(gateways, key)
+        broadcast_presence(shared._PRESENCE_LEAVE, left)
+        set_interest(channel_workers, key, shared._PRESENCE_SNAPSHOT, [])
+
+def handle_message(conn_socket: socket.socket, conn_address: tuple[str, int], header: tuple, payload: memoryview) -> bool:
+    _type, _sub_type, _len, _sub_len = header
+    metrics.frames_in.inc(_type)
+    metrics.bytes_in.inc(_type, shared._HEADER_SIZE + _len)
+    activity[conn_socket] = time.monotonic()
+
+    # check if the connection is held with a server, or with a sibling worker
+    conn_is_server = connections.is_server(conn_socket)
+    conn_is_worker = connections.is_worker(conn_socket)
+
+    # received a request for a server list
+    if   _type == 0 and _sub_type == 0:
+        shared.LOG_MESSAGE(f'received a server list request, replying.')
+        share_servers(conn_socket)
+    # received a request for a client list
+    elif _type == 0 and _sub_type == 1:
+        shared.LOG_MESSAGE(f'received a client list request, replying.')
+        share_clients(conn_socket)
+    # received a change to the servers a sibling worker is connected to
+    elif _type == 1 and _sub_type == 0 and conn_is_worker:
+        update_gateways(connections.worker_index(conn_socket), _sub_len & shared._LIST_OPERATION,
+                        shared.decode_servers(payload))
+    # received an answer for a server list request
+    elif _type == 1 and _sub_type == 0:
+        shared.LOG_MESSAGE(f'received an answer for a server list request,'
+                           + '\n\tbut it was not requested.'
+                           + f'\n\tsender {conn_address}.')
+        # unused functionality
+    # received a change to the clients a sibling worker can reach
+    elif _type == 1 and _sub_type == 1 and conn_is_worker:
+        update_workers(connections.worker_index(conn_socket), _sub_len, shared.decode_clients(payload))
+    # received a client list, or a change to it, from a server
+    elif _type == 1 and _sub_type == 1:
+        server_addr = connections.server_address(conn_socket)
+        if server_addr is None:
+            shared.LOG_MESSAGE(f'received a client list from {conn_address}, but it is not a server.')
+            return True
+        # only the first chunk of a snapshot replaces what we know about the server
+        operation = _sub_len & shared._LIST_OPERATION
+        if _sub_len & shared._LIST_CONTINUED and operation == shared._PRESENCE_SNAPSHOT:
+            operation = shared._PRESENCE_JOIN
+        update_routes(server_addr, operation, shared.decode_clients(payload))
+    # received a request for setting a server username
+    elif _type == 2 and _sub_type == 0:
+        shared.LOG_MESSAGE(f'received a request for registering a server.'
+                           + f'\n\tsender {conn_address}.')
+        server_port = int(shared.decode(payload))
+        register_server((conn_address[0], server_port), conn_socket)
+        shared.LOG_MESSAGE(f'registered {conn_address} as server at port {server_port}.')
+        share_interest(conn_socket)
+
+        # learn which clients can be reached through the new server
+        if args.directory == 'hash':
+            update_ring()
+        else:
+            shared.request_clients(conn_socket)
+    # received a request for setting a client username
+    elif _type == 2 and _sub_type == 1:
+        # register the connection under the requested username,
+        # if it is already taken, close connection and show an error
+        username = shared.decode(payload)
+        if not connections.claim_client(username, conn_socket):
+            shared.LOG_ERROR(f'requested username "{username}" by {conn_address} is already taken!'
+                             + '\n\tclosing connection...')
+            conn_socket.close()
+            return False
+
+        shared.LOG_MESSAGE(f'registered {conn_address} as "{username}".')
+
+        # let the other servers route messages for this client to us
+        announce_client(username, joined=True)
+
+        # and hand over what was kept for it while it was away
+        drain_offline(username, conn_socket)
+    # received a request for direct message forwarding
+    elif _type == 3:
+        received = time.perf_counter()
+
+        # only the recipient is needed for routing, the message is forwarded as is
+        try:
+            recipient = shared.unpack_recipient(payload, _sub_len)
+        except ValueError as err:
+            shared.LOG_ERROR(f'dropping a malformed message from {conn_address}.\n\t{err}')
+            return True
+        bytes_header = shared.pack_header(*header)
+
+        recipient_conn = connections.client(recipient)
+        route = routes.get(recipient)
+        if route is None and recipient_conn is None and not conn_is_server and args.directory == 'hash':
+            route = locations.get(recipient)
+        route_conn = connections.server(route) if route is not None else None
+
+        # messages from a sibling worker are never sent back to the siblings
+        if not conn_is_worker:
+            recipient_conn = recipient_conn or connections.worker(hosted.get(recipient))
+            relay_conn = connections.worker(relays.get(recipient))
+        else:
+            relay_conn = None
+
+        # if a direct connection with recipient is established, forward the message directly
+        if recipient_conn is not None:
+            log.logger.message('forwarding message', recipient=recipient, bytes=_len)
+            shared.send_via_socket(recipient_conn, bytes_header, payload)
+
+            # a flooded message means the sending server had no route, teach it one
+            if conn_is_server and _sub_type & shared._MESSAGE_FLOODED:
+                shared.send_clients(conn_socket, [recipient], shared._PRESENCE_JOIN)
+        # a message for an offline recipient, handed to us as the owner of its directory record
+        elif conn_is_server and _sub_type & shared._MESSAGE_OFFLINE:
+            location_conn = connections.server(records.get(recipient))
+            if location_conn is not None:
+                # the recipient registered in the meantime
+                shared.send_via_socket(location_conn, shared.pack_header(_type, _sub_type & ~shared._MESSAGE_OFFLINE,
+                                                                         _len, _sub_len), payload)
+            elif offline is not None:
+                keep_offline(recipient, bytes_header, payload, owner=True)
+        # if the sender is a server, drop the message to avoid flooding
+        elif conn_is_server:
+            log.logger.message('dropping message for an unknown recipient from a server', recipient=recipient)
+
+            # a routed message means the sending server has a stale route, tell it to forget it,
+            # and keep the message until the recipient shows up again
+            if not _sub_type & shared._MESSAGE_FLOODED:
+                shared.send_clients(conn_socket, [recipient], shared._PRESENCE_LEAVE)
+                if offline is not None:
+                    keep_offline(recipient, bytes_header, payload)
+        # if the recipient is known to be on another server, send it only there
+        elif route_conn is not None:
+            log.logger.message('routing message', recipient=recipient, bytes=_len, via=route)
+            if not shared.send_via_socket(route_conn, bytes_header, payload):
+                # the route broke, forget it and locate the recipient again
+                locations.invalidate(recipient, route)
+                locate_recipient(recipient, bytes_header, payload)
+        # if a sibling worker has a route to the recipient, let it forward the message
+        elif relay_conn is not None:
+            log.logger.message('relaying message', recipient=recipient, bytes=_len, worker=relays.get(recipient))
+            shared.send_via_socket(relay_conn, bytes_header, payload)
+        # a sibling worker missed, try the servers connected to this worker
+        elif conn_is_worker:
+            flood_message(recipient, bytes_header, payload, workers=False)
+        # otherwise find out where the recipient is
+        else:
+            locate_recipient(recipient, bytes_header, payload)
+
+        metrics.forward_latency.observe(time.perf_counter() - received)
+    # received a channel publish, deliver it to the subscribers and pass it on
+    elif _type == 8 and _sub_type & shared._CHANNEL_OPERATION == shared._CHANNEL_PUBLISH:
+        publish(conn_socket, header, payload, conn_is_server, conn_is_worker)
+    # received a subscription change from a client
+    elif _type == 8 and _sub_type in (shared._CHANNEL_SUBSCRIBE, shared._CHANNEL_UNSUBSCRIBE):
+        if connections.role(conn_socket) != registry.CLIENT:
+            shared.LOG_MESSAGE(f'received a subscription from {conn_address}, but it is not a client.')
+            return True
+        channel = shared.decode(payload)
+        if _sub_type == shared._CHANNEL_SUBSCRIBE:
+            subscribe(conn_socket, channel)
+        else:
+            unsubscribe(conn_socket, [channel])
+    # received the channels a server or sibling worker wants publishes for
+    elif _type == 8 and _sub_type == shared._CHANNEL_INTEREST and (conn_is_server or conn_is_worker):
+        table, key = ((channel_workers, connections.worker_index(conn_socket)) if conn_is_worker
+                      else (channel_servers, connections.server_address(conn_socket)))
+        set_interest(table, key, _sub_len, shared.decode_clients(payload))
+    # received a request for the server's metrics
+    elif _type == 6 and _sub_type == 0:
+        share_metrics(conn_socket)
+    # received an echo probe, answer it or pass it on to the server it is meant for
+    elif _type == 4 and _sub_type == shared._PROBE_REQUEST:
+        handle_probe(conn_socket, header, payload)
+    # received the answer to a probe we passed on, return it to whoever sent the probe
+    elif _type == 4 and conn_is_server:
+        return_probe(header, payload)
+    # received a heartbeat, answer pings. any frame already counts as a sign of life
+    elif _type == 7 and _sub_type == shared._HEARTBEAT_PING:
+        shared.send_heartbeat(conn_socket, shared._HEARTBEAT_PONG)
+    # received a directory request or answer from a server
+    elif _type == 5 and conn_is_server:
+        handle_directory(conn_socket, _sub_type, shared.decode(payload))
+    # received the codecs a client or server decodes, offer ours back if it asked.
+    # sibling workers share the host, their links aren't compressed
+    elif _type == 9 and not conn_is_worker:
+        compress.compression.accept(conn_socket, bytes(payload), _sub_len)
+        if _sub_type == shared._COMPRESS_OFFER:
+            shared.send_offer(conn_socket, shared._COMPRESS_ANSWER)
+
+    return True
+
+def locate_recipient(recipient: str, bytes_header: bytes, payload: memoryview) -> None:
+    # ask the owner of the recipient's directory record where to send it,
+    # or without a directory, broadcast the message to other servers
+    if args.directory == 'hash':
+        lookup_location(recipient, bytes_header, payload)
+    else:
+        undeliverable(recipient, bytes_header, payload)
+
+def undeliverable(recipient: str, bytes_header: bytes, payload: memoryview) -> None:
+    # nobody is known to have the recipient. keep the message until it registers,
+    # or without a store broadcast it to the other servers
+    if offline is None:
+        flood_message(recipient, bytes_header, payload)
+    else:
+        keep_offline(recipient, bytes_header, payload)
+
+def flood_message(recipient: str, bytes_header: bytes, payload: memoryview, workers: bool = True) -> None:
+    _type, _sub_type, _len, _sub_len = shared._HEADER.unpack(bytes_header)
+    log.logger.message('broadcasting message', recipient=recipient, bytes=_len)
+    flooded_header = shared.pack_header(_type, _sub_type | shared._MESSAGE_FLOODED, _len, _sub_len)
+    broadcast_to_servers(flooded_header, payload)
+
+    # the sibling workers pass it on to the servers connected to them
+    if workers:
+        for worker in connections.worker_connections():
+            shared.send_via_socket(worker, flooded_header, payload)
 
 def share_servers(requester: socket.socket) -> None:
     # prepare a list of available servers, skip requester
-    server_list = [f'{addr}:{port}' for (addr, port), sock in servers.items() if sock != requester]
-    server_list.append(f'{shared._LOCALHOST}:{shared._PORTS[port_index]}')
+    server_list = [addr for addr, sock in connections.server_items() if sock != requester]
+    server_list.extend(gateways)
+    server_list.append((shared._LOCALHOST, shared._PORTS[port_index]))
 
-    # prepare the message data
-    data = '\0'.join(server_list)
-    shared.send_servers(requester, data)
+    shared.send_servers(requester, server_list)
 
 def share_clients(requester: socket.socket) -> None:
-    # prepare a list of available clients
-    client_list = [username for username in clients.keys()]
+    # prepare a list of available clients, including the ones of sibling workers
+    client_list = connections.client_names() + list(hosted)
+
+    shared.send_clients(requester, client_list, shared._PRESENCE_SNAPSHOT)
+
+def announce_client(username: str, joined: bool) -> None:
+    # sibling workers deliver to the client through us, and announce it to their own servers
+    share_with_workers(1, 1, shared.encode_clients([username]),
+                       shared._PRESENCE_JOIN if joined else shared._PRESENCE_LEAVE)
+
+    if args.directory == 'hash':
+        # only the owner of the username's record has to know
+        if joined:
+            register_location(username, self_address())
+        else:
+            unregister_location(username, self_address())
+    else:
+        broadcast_presence(shared._PRESENCE_JOIN if joined else shared._PRESENCE_LEAVE, [username])
+
+def broadcast_presence(operation: int, usernames: list[str]) -> None:
+    # encode once, the same frames go to every server
+    frames = shared.list_frames(1, 1, shared.encode_clients(usernames), operation)
+    servers = connections.server_connections()
+    for server in servers:
+        for frame in frames:
+            shared.send_via_socket(server, frame)
+    metrics.fanout.observe(len(servers), 'presence')
+
+def update_routes(server_addr: tuple[str, int], operation: int, usernames: list[str]) -> None:
+    # messages kept for these clients can go to them now
+    if operation != shared._PRESENCE_LEAVE:
+        for username in usernames:
+            drain_offline(username, connections.server(server_addr))
+
+    # without gossip, what servers tell us about their clients is only cached
+    if args.directory == 'hash':
+        for username in usernames:
+            if operation == shared._PRESENCE_LEAVE:
+                locations.invalidate(username, server_addr)
+            else:
+                locations.put(username, server_addr)
+        return
+
+    # a snapshot replaces everything previously learned about the server
+    dropped = []
+    if operation == shared._PRESENCE_SNAPSHOT:
+        dropped = [username for username, route in list(routes.items()) if route == server_addr]
+        for username in dropped:
+            routes.pop(username, None)
+
+    if operation == shared._PRESENCE_LEAVE:
+        for username in usernames:
+            if routes.get(username) == server_addr:
+                routes.pop(username, None)
+                dropped.append(username)
+        usernames = []
+    else:
+        for username in usernames:
+            routes[username] = server_addr
+
+    # sibling workers reach these clients through us
+    share_with_workers(1, 1, shared.encode_clients(usernames), shared._PRESENCE_JOIN | shared._LIST_RELAYED)
+    share_with_workers(1, 1, shared.encode_clients([username for username in dropped if username not in routes]),
+                       shared._PRESENCE_LEAVE | shared._LIST_RELAYED)
+
+def register_server(addr: tuple[str, int], conn: socket.socket) -> None:
+    connections.add_server(addr, conn)
 
-    # prepare the message data
-    data = '\0'.join(client_list)
-    shared.send_clients(requester, data)
+    # sibling workers hand the server out in their server lists
+    share_with_workers(1, 0, shared.encode_servers([addr]), shared._PRESENCE_JOIN)
 
-def request_servers(server: socket.socket) -> list[tuple[str, int]]:
+def request_servers(server: socket.socket, server_addr: tuple[str, int]) -> list[tuple[str, int]]:
     # perform the request
     shared.request_servers(server)
 
-    response = shared.receive_via_socket(server)
+    addresses = []
+    while True:
+        response = shared.receive_via_socket(server)
 
-    # if caught any errors
-    if response['error'] is not None:
-        # close the socket, and end the thread
-        server.close()
-        return None
-    
-    # break up addresses and return as a list
-    return [(address.split(':')[0], int(address.split(':')[1])) for address in response['data'].split('\0')]
+        # if caught any errors
+        if response['error'] is not None:
+            # close the socket, and end the thread
+            server.close()
+            return None
 
-def connect_to_servers(addresses: list[tuple[str, int]]) -> None:
-    global servers
+        payload = memoryview(response['bytes_data'] or b'')
+
+        # collect the list until its last chunk arrives
+        if response['type'] == 1 and response['sub_type'] == 0:
+            addresses.extend(shared.decode_servers(payload))
+            if not response['sub_len'] & shared._LIST_MORE:
+                return addresses
+            continue
+
+        # the server may ask for our clients before answering, handle those messages as usual
+        header = (response['type'], response['sub_type'], response['len'], response['sub_len'])
+        handle_message(server, server_addr, header, payload)
 
+def connect_to_servers(addresses: list[tuple[str, int]]) -> None:
     for ip, port in addresses:
         # skip ourselves
         if ip == shared._LOCALHOST and port == shared._PORTS[port_index]:
             continue
 
         # skip connected
-        if (ip, port) in servers.keys():
+        if connections.has_server((ip, port)) or (ip, port) in gateways:
             continue
 
         # connect to server, and register connection socket
-        conn = shared.attempt_handshake(ip, port)
+        conn = shared.attempt_handshake(ip, port, args.nodelay)
         if conn is None:
             continue
-        servers[(ip, port)] = conn
+        tune_socket(conn)
+        register_server((ip, port), conn)
 
         # register as server
         shared.set_username(conn, str(shared._PORTS[port_index]), False)
+        share_interest(conn)
+
+# echo probes
+def handle_probe(conn_socket: socket.socket, header: tuple, payload: memoryview) -> None:
+    _type, _sub_type, _len, _sub_len = header
+    try:
+        seq, sent_ns, hops, target = shared.unpack_probe(payload, _sub_len)
+        target_addr = directory.parse_node_id(target) if target else None
+    except (struct.error, ValueError):
+        return
+
+    # the probe is for us, send it right back
+    if target_addr is None or target_addr == self_address():
+        shared.send_via_socket(conn_socket, shared.pack_header(4, shared._PROBE_REPLY, _len, _sub_len), payload)
+        return
+
+    target_conn = connections.server(target_addr)
+    if target_conn is None:
+        shared.send_via_socket(conn_socket, shared.pack_header(4, shared._PROBE_UNREACHABLE, _len, _sub_len), payload)
+        return
+
+    # remember who to return the answer to, the sequence number and send time identify the probe
+    with probes_lock:
+        probes[bytes(payload[:shared._PROBE.size - 1])] = conn_socket
+        while len(probes) > shared._PROBE_PENDING_LIMIT:
+            probes.pop(next(iter(probes)))
+
+    forwarded = bytearray(payload)
+    shared._PROBE.pack_into(forwarded, 0, seq, sent_ns, min(hops + 1, 0xFF))
+    shared.send_via_socket(target_conn, shared.pack_header(*header), forwarded)
+
+def return_probe(header: tuple, payload: memoryview) -> None:
+    with probes_lock:
+        origin = probes.pop(bytes(payload[:shared._PROBE.size - 1]), None)
+    if origin is not None:
+        shared.send_via_socket(origin, shared.pack_header(*header), payload)
+
+# consistent hash directory
+def self_address() -> tuple[str, int]:
+    return (shared._LOCALHOST, shared._PORTS[port_index])
+
+def update_ring() -> None:
+    global ring, records
+
+    if args.directory != 'hash':
+        return
+
+    # rebuild the ring over the servers we are connected to
+    old_ring = ring
+    ring = directory.HashRing([self_address(), *connections.server_addresses()])
+    if ring.nodes == old_ring.nodes:
+        return
+    shared.LOG_MESSAGE(f'directory ring changed to {len(ring.nodes)} servers.')
+
+    # hand over the records we no longer own
+    for username, location in list(records.items()):
+        owner = ring.owner(username)
+        if owner != self_address():
+            del records[username]
+            send_to_owner(owner, shared._DIRECTORY_REGISTER, f'{username}\0{directory.node_id(location)}')
+
+    # re-register our clients whose owner changed, their old owner may be gone
+    for username in connections.client_names():
+        if old_ring.owner(username) != ring.owner(username):
+            register_location(username, self_address())
+
+def send_to_owner(owner: tuple[str, int], sub_type: int, data: str) -> bool:
+    owner_conn = connections.server(owner)
+    if owner_conn is None:
+        return False
+    shared.send_directory(owner_conn, sub_type, data)
+    return True
+
+def register_location(username: str, location: tuple[str, int]) -> None:
+    owner = ring.owner(username)
+    if owner == self_address():
+        records[username] = location
+        drain_offline(username, connections.client(username) if location == self_address() else connections.server(location))
+    else:
+        send_to_owner(owner, shared._DIRECTORY_REGISTER, f'{username}\0{directory.node_id(location)}')
+
+def unregister_location(username: str, location: tuple[str, int]) -> None:
+    owner = ring.owner(username)
+    if owner == self_address():
+        if records.get(username) == location:
+            del records[username]
+    else:
+        send_to_owner(owner, shared._DIRECTORY_UNREGISTER, f'{username}\0{directory.node_id(location)}')
+
+def lookup_location(recipient: str, bytes_header: bytes, payload: memoryview) -> None:
+    owner = ring.owner(recipient)
+
+    # we own the record ourselves
+    if owner == self_address():
+        location = records.get(recipient)
+        location_conn = connections.server(location)
+        if location_conn is not None:
+            locations.put(recipient, location)
+            shared.send_via_socket(location_conn, bytes_header, payload)
+        else:
+            undeliverable(recipient, bytes_header, payload)
+        return
+
+    # hold the message until the owner answers, one lookup per recipient at a time
+    with lookups_lock:
+        started, held = lookups.get(recipient, (None, None))
+        expired = started is not None and time.monotonic() - started > directory._LOOKUP_TIMEOUT
+        if started is None or expired:
+            lookups[recipient] = (time.monotonic(), [(bytes_header, bytes(payload))])
+        else:
+            held.append((bytes_header, bytes(payload)))
+
+    # the previous lookup went unanswered, don't hold its messages any longer
+    if expired:
+        for held_header, held_payload in held:
+            undeliverable(recipient, held_header, memoryview(held_payload))
+
+    if started is None or expired:
+        if not send_to_owner(owner, shared._DIRECTORY_LOOKUP, recipient):
+            release_lookup(recipient, None)
+
+def release_lookup(username: str, location: tuple[str, int]) -> None:
+    with lookups_lock:
+        _, held = lookups.pop(username, (None, []))
 
-def broadcast_to_servers(bytes_header: bytes, bytes_data: bytes) -> None:
-    for server in servers.values():
+    # route the held messages to where the user is, or keep or flood them if that is unknown
+    target = connections.client(username) or connections.server(location)
+    if target is not None:
+        log.logger.message('located recipient', recipient=username, location=location, held=len(held))
+        if connections.is_server(target):
+            locations.put(username, location)
+        for held_header, held_payload in held:
+            shared.send_via_socket(target, held_header, held_payload)
+    else:
+        for held_header, held_payload in held:
+            undeliverable(username, held_header, memoryview(held_payload))
+
+def handle_directory(conn_socket: socket.socket, sub_type: int, data: str) -> None:
+    username, _, location = data.partition('\0')
+    location = directory.parse_node_id(location) if location else None
+
+    if   sub_type == shared._DIRECTORY_REGISTER:
+        register_location(username, location)
+    elif sub_type == shared._DIRECTORY_UNREGISTER:
+        unregister_location(username, location)
+    elif sub_type == shared._DIRECTORY_LOOKUP:
+        location = records.get(username)
+        answer = directory.node_id(location) if location else ''
+        shared.send_directory(conn_socket, shared._DIRECTORY_ANSWER, f'{username}\0{answer}')
+    elif sub_type == shared._DIRECTORY_ANSWER:
+        release_lookup(username, location)
+
+def broadcast_to_servers(bytes_header: bytes, bytes_data: memoryview) -> None:
+    servers = connections.server_connections()
+    for server in servers:
         shared.send_via_socket(server, bytes_header, bytes_data)
+    metrics.fanout.observe(len(servers), 'flood')
+
+# offline messages
+def keep_offline(recipient: str, bytes_header: bytes, payload: memoryview, owner: bool = False) -> None:
+    # the message waits where the recipient's registration will be noticed: with the hash
+    # directory at the owner of its record, otherwise here, every registration is announced
+    _type, _sub_type, _len, _sub_len = shared._HEADER.unpack(bytes_header)
+    _sub_type &= ~(shared._MESSAGE_FLOODED | shared._MESSAGE_OFFLINE)
+
+    if args.directory == 'hash' and not owner:
+        owner_addr = ring.owner(recipient)
+        owner_conn = connections.server(owner_addr) if owner_addr != self_address() else None
+        offline_header = shared.pack_header(_type, _sub_type | shared._MESSAGE_OFFLINE, _len, _sub_len)
+        if owner_conn is not None and shared.send_via_socket(owner_conn, offline_header, payload):
+            log.logger.message('handing message to the directory owner', recipient=recipient, bytes=_len, via=owner_addr)
+            return
+
+    log.logger.message('storing message', recipient=recipient, bytes=_len)
+    offline.put(recipient, b''.join((shared.pack_header(_type, _sub_type, _len, _sub_len), payload)))
+
+def drain_offline(username: str, target: socket.socket) -> None:
+    # send everything kept for username in one go, the frames are written from the
+    # store's segment files and the writer batches them
+    if offline is None or target is None or not offline.has(username):
+        return
+    frames = offline.take(username)
+    shared.LOG_MESSAGE(f'delivering {len(frames)} stored messages for {username}.')
+    if not shared.send_stored(target, frames):
+        # the connection went away meanwhile, store them again for the next registration
+        for frame in frames:
+            offline.put(username, bytes(frame.view()))
+        shared.LOG_MESSAGE(f'stored the {len(frames)} messages for {username} again.')
+
+# channels
+def publish(conn_socket: socket.socket, header: tuple, payload: memoryview, conn_is_server: bool, conn_is_worker: bool) -> None:
+    _type, _sub_type, _len, _sub_len = header
+    try:
+        channel = shared.unpack_recipient(payload, _sub_len)
+    except ValueError as err:
+        shared.LOG_ERROR(f'dropping a malformed publish.\n\t{err}')
+        return
+
+    # clients can't claim their publish was relayed
+    if not conn_is_server and not conn_is_worker:
+        _sub_type = shared._CHANNEL_PUBLISH
+
+    # encoded once, the queue of every subscriber holds this same frame
+    frame = b''.join((shared.pack_header(_type, _sub_type, _len, _sub_len), payload))
+    members = subscribers.get(channel, ())
+    for member in members:
+        if member is not conn_socket:
+            shared.send_via_socket(member, frame)
+    metrics.fanout.observe(len(members), 'channel')
+    log.logger.message('publishing message', channel=channel, bytes=_len, subscribers=len(members))
+
+    # a publish crosses one server link at most, with a sibling worker link on either side
+    relayed = _sub_type & shared._CHANNEL_RELAYED
+    if not conn_is_server and not (conn_is_worker and relayed):
+        servers = [connections.server(addr) for addr in channel_servers.get(channel, ())]
+        if servers:
+            relayed_frame = shared.pack_header(_type, _sub_type | shared._CHANNEL_RELAYED, _len, _sub_len) \
+                            + frame[shared._HEADER_SIZE:]
+        for server in servers:
+            if server is not None:
+                shared.send_via_socket(server, relayed_frame)
+    if not conn_is_worker:
+        for index in channel_workers.get(channel, ()):
+            worker = connections.worker(index)
+            if worker is not None:
+                shared.send_via_socket(worker, frame)
+
+def subscribe(conn: socket.socket, channel: str) -> None:
+    with channels_lock:
+        subscribers[channel] = subscribers.get(channel, frozenset()) | {conn}
+        subscriptions.setdefault(conn, set()).add(channel)
+        changes = update_interest([channel])
+    announce_interest(changes)
+
+def unsubscribe(conn: socket.socket, channels: list[str]) -> None:
+    with channels_lock:
+        for channel in channels:
+            members = subscribers.get(channel, frozenset()) - {conn}
+            if members:
+                subscribers[channel] = members
+            else:
+                subscribers.pop(channel, None)
+            subscriptions.get(conn, set()).discard(channel)
+        if not subscriptions.get(conn):
+            subscriptions.pop(conn, None)
+        changes = update_interest(channels)
+    announce_interest(changes)
+
+def set_interest(table: dict, key, sub_len: int, channels: list[str]) -> None:
+    # a server or sibling worker told us which channels it wants publishes for,
+    # only the first chunk of a snapshot replaces what it told us before
+    operation = sub_len & shared._LIST_OPERATION
+    with channels_lock:
+        changed = set(channels)
+        if operation == shared._PRESENCE_SNAPSHOT and not sub_len & shared._LIST_CONTINUED:
+            for channel, keys in list(table.items()):
+                if key in keys:
+                    changed.add(channel)
+                    table[channel] = keys - {key}
+
+        for channel in channels:
+            if operation == shared._PRESENCE_LEAVE:
+                table[channel] = table.get(channel, frozenset()) - {key}
+            else:
+                table[channel] = table.get(channel, frozenset()) | {key}
+
+        for channel in changed:
+            if not table.get(channel):
+                table.pop(channel, None)
+        changes = update_interest(changed)
+    announce_interest(changes)
 
+def update_interest(channels) -> list[tuple[str, int, list[str]]]:
+    # called with the channels lock held. servers are told about the channels our clients
+    # or sibling workers want, sibling workers about the ones our clients or servers want.
+    # returns the (peers, operation, channels) changes to announce
+    joined = {'servers': [], 'workers': []}
+    left   = {'servers': [], 'workers': []}
+    for channel in channels:
+        local = channel in subscribers
+        for peers, wanted in (('servers', local or channel in channel_workers),
+                              ('workers', local or channel in channel_servers)):
+            told = told_channels[peers]
+            if wanted and channel not in told:
+                told.add(channel)
+                joined[peers].append(channel)
+            elif not wanted and channel in told:
+                told.discard(channel)
+                left[peers].append(channel)
+
+    return [(peers, operation, names) for peers in ('servers', 'workers')
+            for operation, names in ((shared._PRESENCE_JOIN, joined[peers]), (shared._PRESENCE_LEAVE, left[peers]))
+            if names]
+
+def announce_interest(changes: list[tuple[str, int, list[str]]]) -> None:
+    for peers, operation, channels in changes:
+        entries = shared.encode_clients(channels)
+        if peers == 'workers':
+            share_with_workers(8, shared._CHANNEL_INTEREST, entries, operation)
+            continue
+        frames = shared.list_frames(8, shared._CHANNEL_INTEREST, entries, operation)
+        for server in connections.server_connections():
+            for frame in frames:
+                shared.send_via_socket(server, frame)
+
+def share_interest(server: socket.socket) -> None:
+    # a server that just joined gets every channel it should send publishes for. sent
+    # outside the lock, a slow server doesn't hold up subscribes and publishes
+    with channels_lock:
+        frames = shared.list_frames(8, shared._CHANNEL_INTEREST, shared.encode_clients(sorted(told_channels['servers'])),
+                                    shared._PRESENCE_SNAPSHOT)
+    for frame in frames:
+        shared.send_via_socket(server, frame)
+
+# connection liveness
+def reap_period() -> float:
+    # how often connections are checked, 0 with heartbeats and idle timeouts both off
+    limits = [limit for limit in (args.heartbeat_interval, args.idle_timeout) if limit > 0]
+    return min(limits) / 2 if limits else 0.0
+
+def reap_idle() -> None:
+    # ping the connections that went quiet, and shut down the ones that stayed quiet for
+    # the idle timeout. their readers then close and unregister them as usual, freeing
+    # their registry entries and threads
+    now = time.monotonic()
+    for conn in connections.connections():
+        # sibling workers share the host, their links don't go half open
+        if connections.is_worker(conn):
+            continue
+
+        idle = now - activity.setdefault(conn, now)
+        if args.idle_timeout > 0 and idle >= args.idle_timeout:
+            role = connections.role(conn)
+            shared.LOG_MESSAGE(f'closing {role} connection, idle for {idle:.1f}s.')
+            metrics.reaped.inc(role)
+            activity[conn] = float('inf')  # reaped once, the reader unregisters it
+            conn.shutdown()
+        elif args.heartbeat_interval > 0 and idle >= args.heartbeat_interval:
+            # never wait on a full queue here, a peer that stopped reading is left to the
+            # idle timeout instead of holding up the checks of every other connection
+            if hasattr(conn, 'full') and conn.full(shared._HEADER_SIZE):
+                continue
+            shared.send_heartbeat(conn, shared._HEARTBEAT_PING)
+
+    # forget connections that were unregistered while being checked
+    for conn in list(activity):
+        if connections.role(conn) is None:
+            activity.pop(conn, None)
+
+def reap_connections() -> None:
+    while True:
+        time.sleep(reap_period())
+        reap_idle()
+
+async def reap_streams() -> None:
+    # the stream connections belong to the loop, check them on it
+    while True:
+        await asyncio.sleep(reap_period())
+        reap_idle()
+
+# metrics
+def register_gauges() -> None:
+    # computed only when scraped
+    metrics.registry.gauge('chat_connections', 'Open connections, by role.', connections.role_counts, 'role')
+    metrics.registry.gauge('chat_queued_bytes', 'Bytes waiting in outbound queues.', lambda: queue_totals('queued_bytes'))
+    metrics.registry.gauge('chat_queued_frames', 'Frames waiting in outbound queues.', lambda: queue_totals('queued_frames'))
+    metrics.registry.gauge('chat_dropped_frames_total', 'Frames dropped by the outbound queue policy, of open connections.',
+                           lambda: queue_totals('dropped_frames'), kind='counter')
+    # frames per write shows what write coalescing saves in syscalls
+    metrics.registry.gauge('chat_writes_total', 'Writes to the socket by outbound queues, of open connections.',
+                           lambda: queue_totals('writes'), kind='counter')
+    metrics.registry.gauge('chat_sent_frames_total', 'Frames written by outbound queues, of open connections.',
+                           lambda: queue_totals('sent_frames'), kind='counter')
+    metrics.registry.gauge('chat_frames_per_write', 'Frames per socket write by outbound queues, of open connections.',
+                           frames_per_write)
+    if offline is not None:
+        metrics.registry.gauge('chat_offline_store', 'Offline message store statistics.', offline.stats, 'stat')
+    metrics.registry.gauge('chat_channels', 'Channels with subscribers on this server.', lambda: len(subscribers))
+    metrics.registry.gauge('chat_routes', 'Usernames routed to other servers.', lambda: len(routes))
+    metrics.registry.gauge('chat_log_records_skipped_total', 'Log records not written, by reason.',
+                           log.logger.stats, 'reason', kind='counter')
+    metrics.registry.gauge('chat_location_cache', 'Recipient location cache statistics.',
+                           lambda: {key: value for key, value in locations.stats().items() if key != 'capacity'}, 'stat')
+
+def queue_totals(key: str) -> int:
+    return sum(conn.stats()[key] for conn in connections.connections() if hasattr(conn, 'stats'))
+
+def frames_per_write() -> float:
+    writes = queue_totals('writes')
+    return round(queue_totals('sent_frames') / writes, 3) if writes else 0.0
+
+def share_metrics(requester: socket.socket) -> None:
+    # one line per entry, split over as many frames as needed
+    lines = [line.encode() + b'\n' for line in metrics.registry.render().splitlines()]
+    for frame in shared.list_frames(6, 1, lines):
+        shared.send_via_socket(requester, frame)
+
+def serve_metrics(path: str) -> None:
+    # plain http over a unix socket, for scrapers: curl --unix-socket <path> http://localhost/metrics
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            try:
+                conn.recv(4096)
+                body = metrics.registry.render().encode()
+                conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            except OSError:
+                pass
+
+# worker processes
+def spawn_workers(count: int) -> tuple[int, list[tuple[int, socket.socket]]]:
+    # link every two workers with a unix socket pair, then fork the workers.
+    # returns the index of this worker, and its links as (sibling index, socket)
+    pairs = {(i, j): socket.socketpair() for i in range(count) for j in range(i + 1, count)}
+    index = 0
+    for child in range(1, count):
+        if os.fork() == 0:
+            index = child
+            break
+
+    links = []
+    for (i, j), (sock_i, sock_j) in pairs.items():
+        if i == index:
+            links.append((j, sock_i))
+            sock_j.close()
+        elif j == index:
+            links.append((i, sock_j))
+            sock_i.close()
+        else:
+            sock_i.close()
+            sock_j.close()
+    return index, links
+
+def share_with_workers(_type: int, _sub_type: int, entries: list[bytes], operation: int) -> None:
+    workers = connections.worker_connections()
+    if not workers or not entries:
+        return
+
+    # encode once, the same frames go to every sibling
+    frames = shared.list_frames(_type, _sub_type, entries, operation)
+    for worker in workers:
+        for frame in frames:
+            shared.send_via_socket(worker, frame)
+
+def update_workers(index: int, sub_len: int, usernames: list[str]) -> None:
+    # clients connected to the sibling, or reachable through its servers
+    table = relays if sub_len & shared._LIST_RELAYED else hosted
+    operation = sub_len & shared._LIST_OPERATION
+    if operation == shared._PRESENCE_LEAVE:
+        for username in usernames:
+            if table.get(username) == index:
+                table.pop(username, None)
+    else:
+        for username in usernames:
+            table[username] = index
+            drain_offline(username, connections.worker(index))
+
+    # clients of a sibling are clients of this node, our servers reach them through us
+    if table is hosted:
+        broadcast_presence(operation, usernames)
+
+def update_gateways(index: int, operation: int, addresses: list[tuple[str, int]]) -> None:
+    for addr in addresses:
+        if operation == shared._PRESENCE_LEAVE:
+            if gateways.get(addr) == index:
+                gateways.pop(addr, None)
+        else:
+            gateways[addr] = index
+
+def drop_worker_entries(table: dict, index: int) -> list:
+    dropped = [key for key, worker in list(table.items()) if worker == index]
+    for key in dropped:
+        table.pop(key, None)
+    return dropped
+
+# asyncio engine
+async def receive_frame(reader: asyncio.StreamReader) -> tuple[tuple, memoryview]:
+    # same framing as shared.FrameReader, readexactly takes care of partial reads
+    header = shared._HEADER.unpack(await reader.readexactly(shared._HEADER_SIZE))
+    payload = await reader.readexactly(header[2]) if header[2] else b''
+    if header[0] & shared._COMPRESSED:
+        return shared.inflate_frame(header, payload)
+    return header, memoryview(payload)
+
+async def respond_to_stream(reader: asyncio.StreamReader, conn: outbound.StreamConnection, conn_address: tuple[str, int]) -> None:
+    try:
+        while True:
+            header, payload = await receive_frame(reader)
+
+            # handle the message, end the task if the connection got closed
+            if not handle_message(conn, conn_address, header, payload):
+                break
+
+            # pause reading while anything we wrote to is over its high watermark
+            if outbound.congested():
+                await outbound.drain_congested()
+    except (asyncio.IncompleteReadError, OSError):
+        # the connection was closed or reset
+        pass
+    outbound.StreamConnection.congested.pop(asyncio.current_task(), None)
+
+    # close the connection, forget it, and end the task
+    conn.close()
+    unregister_connection(conn)
+    shared.LOG_MESSAGE(f'connection with {conn_address} has been closed.')
+
+def stream_connection(writer: asyncio.StreamWriter) -> outbound.StreamConnection:
+    return outbound.StreamConnection(writer, args.queue_high, args.queue_low, args.queue_policy,
+                                     args.batch_interval / 1e6, args.batch_bytes)
+
+async def await_streams(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    conn = stream_connection(writer)
+    conn_address = conn.getpeername()
+    tune_socket(writer.get_extra_info('socket'))
+    connections.add_pending(conn)
+    shared.LOG_MESSAGE(f'connection with {conn_address} established.')
+    await respond_to_stream(reader, conn, conn_address)
+
+async def serve_async(listener: socket.socket) -> None:
+    # move the already established server connections onto the loop
+    tasks = []
+    for addr, sock in connections.server_items():
+        reader, writer = await asyncio.open_connection(sock=sock)
+        tune_socket(writer.get_extra_info('socket'))
+        conn = stream_connection(writer)
+        connections.add_server(addr, conn)
+        shared.send_offer(conn, shared._COMPRESS_OFFER)
+        tasks.append(asyncio.create_task(respond_to_stream(reader, conn, addr)))
+
+    # and the links with the sibling workers
+    for index, sock in connections.worker_items():
+        reader, writer = await asyncio.open_connection(sock=sock)
+        conn = stream_connection(writer)
+        connections.add_worker(index, conn)
+        tasks.append(asyncio.create_task(respond_to_stream(reader, conn, ('worker', index))))
+
+    if reap_period():
+        tasks.append(asyncio.create_task(reap_streams()))
+
+    shared.LOG_MESSAGE('awaiting for connections...')
+    async with await asyncio.start_server(await_streams, sock=listener) as server:
+        await server.serve_forever()
+
+def raise_file_limit() -> None:
+    # every client holds a descriptor, allow as many as the hard limit permits
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as err:
+        shared.LOG_ERROR(f'could not raise the open file limit.\n\t{err}')
+
+
+# command line options
+parser = argparse.ArgumentParser()
+parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                    help='serve connections with a thread each, or all on one asyncio event loop')
+parser.add_argument('--directory', choices=('gossip', 'hash'), default='gossip',
+                    help='share every client with every server, or keep each username\'s location '
+                         + 'on the server owning it on a consistent hash ring')
+parser.add_argument('--nodelay', action=argparse.BooleanOptionalAction, default=True,
+                    help='set TCP_NODELAY on client and server connections')
+parser.add_argument('--queue-high', type=int, default=outbound._HIGH_WATERMARK,
+                    help='outbound queue size (bytes) at which the overflow policy applies')
+parser.add_argument('--queue-low', type=int, default=outbound._LOW_WATERMARK,
+                    help='outbound queue size (bytes) at which blocked producers resume')
+parser.add_argument('--queue-policy', choices=outbound.POLICIES, default=outbound.BLOCK,
+                    help='what to do with connections that can\'t keep up with their outbound queue')
+parser.add_argument('--batch-interval', type=float, default=outbound._BATCH_INTERVAL * 1e6,
+                    help='coalesce frames queued within this many microseconds into one write (0 disables)')
+parser.add_argument('--batch-bytes', type=int, default=outbound._BATCH_BYTES,
+                    help='flush a coalesced write as soon as this many bytes are pending')
+parser.add_argument('--cache-size', type=int, default=cache._CACHE_SIZE,
+                    help='recipient locations cached in hash directory mode (0 disables)')
+parser.add_argument('--cache-ttl', type=float, default=cache._CACHE_TTL,
+                    help='seconds a cached recipient location is trusted')
+parser.add_argument('--metrics-socket', metavar='PATH',
+                    help='serve prometheus metrics over http on this unix socket')
+parser.add_argument('--workers', type=int, default=1,
+                    help='serve the port with this many processes, sharing their clients over unix sockets')
+parser.add_argument('--store', metavar='DIR',
+                    help='keep messages for offline recipients in an append-only log under this directory')
+parser.add_argument('--store-segment-size', type=int, default=store._SEGMENT_SIZE,
+                    help='bytes written to a store segment before the next one is started')
+parser.add_argument('--store-commit-interval', type=float, default=store._COMMIT_INTERVAL * 1e3,
+                    help='milliseconds between store fsyncs, writes in between share one (0 syncs every write)')
+parser.add_argument('--heartbeat-interval', type=float, default=shared._HEARTBEAT_INTERVAL,
+                    help='seconds of silence before a connection is pinged (0 disables)')
+parser.add_argument('--idle-timeout', type=float, default=shared._IDLE_TIMEOUT,
+                    help='seconds of silence before a connection is closed (0 disables)')
+parser.add_argument('--keepalive-idle', type=int, default=shared._KEEPALIVE_IDLE,
+                    help='seconds before tcp keepalive probes an idle connection (0 disables keepalive)')
+parser.add_argument('--keepalive-interval', type=int, default=shared._KEEPALIVE_INTERVAL,
+                    help='seconds between tcp keepalive probes')
+parser.add_argument('--keepalive-count', type=int, default=shared._KEEPALIVE_COUNT,
+                    help='unanswered tcp keepalive probes before the connection is dropped')
+parser.add_argument('--compress', action=argparse.BooleanOptionalAction, default=False,
+                    help='offer compression to clients and servers, and compress for those that offer it too')
+parser.add_argument('--compress-threshold', type=int, default=compress._THRESHOLD,
+                    help='payload bytes below which frames are sent uncompressed')
+parser.add_argument('--compress-level', type=int, default=compress._LEVEL, choices=range(1, 10), metavar='1-9')
+parser.add_argument('--compress-dictionary', metavar='PATH',
+                    help="preset dictionary for chat text, 'none' for plain deflate (default: the built-in one)")
+parser.add_argument('--log-level', choices=log.LEVELS, default='info')
+parser.add_argument('--log-format', choices=('text', 'json'), default='text')
+parser.add_argument('--log-messages', action=argparse.BooleanOptionalAction, default=True,
+                    help='log every forwarded message, subject to --log-sample and --log-rate')
+parser.add_argument('--log-sample', type=int, default=1, metavar='N',
+                    help='log one of every N forwarded messages')
+parser.add_argument('--log-rate', type=float, default=1000,
+                    help='forwarded messages logged per second at most (0 for no limit)')
+parser.add_argument('--log-buffer', type=int, default=log._RING_SIZE,
+                    help='log records buffered for the writer before the oldest are dropped')
+args = parser.parse_args()
+if args.workers > 1 and args.directory != 'gossip':
+    parser.error('--workers is only supported with --directory gossip')
+
+log.logger.configure(args.log_level, args.log_messages, args.log_sample, args.log_rate,
+                     args.log_format == 'json', args.log_buffer)
+
+dictionary = compress.CHAT_DICTIONARY
+if args.compress_dictionary == 'none':
+    dictionary = b''
+elif args.compress_dictionary:
+    with open(args.compress_dictionary, 'rb') as file:
+        dictionary = file.read()
+compress.compression.configure(args.compress, args.compress_threshold, args.compress_level, dictionary)
 
 # port selection
 port_index = shared.port_select(shared._PORTS)
-servers = {}
-clients = {}
-temp    = []
 
-# attempt handshakes with everyone (servers), except ourselves
-for p in shared._PORTS:
+# fork the workers, before any threads are started
+worker_index, links = spawn_workers(args.workers) if args.workers > 1 else (0, [])
+
+connections = registry.Registry()
+routes      = {}  # username -> address of the server it is connected to
+
+# sibling worker state
+hosted   = {}  # username -> index of the sibling worker the client is connected to
+relays   = {}  # username -> index of the sibling worker with a route to it
+gateways = {}  # server address -> index of the sibling worker connected to it
+for index, link in links:
+    connections.add_worker(index, link)
+
+# consistent hash directory state
+ring         = directory.HashRing([self_address()])
+records      = {}  # username -> location, for the usernames this server owns
+lookups      = {}  # username -> (lookup start, messages held for the answer)
+lookups_lock = threading.Lock()
+locations    = cache.LocationCache(args.cache_size, args.cache_ttl)  # username -> located server
+
+# connection -> time its last frame arrived
+activity = {}
+
+# messages for offline recipients, one store per worker
+offline = None
+if args.store:
+    store_path = os.path.join(args.store, str(shared._PORTS[port_index]) + (f'.{worker_index}' if args.workers > 1 else ''))
+    offline = store.MessageStore(store_path, args.store_segment_size, args.store_commit_interval / 1e3)
+
+# channels. member sets are replaced rather than changed, so publishes read them without a lock
+subscribers     = {}  # channel -> frozenset of local client connections
+subscriptions   = {}  # client connection -> set of channels it subscribed to
+channel_servers = {}  # channel -> frozenset of addresses of servers that want its publishes
+channel_workers = {}  # channel -> frozenset of indexes of sibling workers that want its publishes
+told_channels   = {'servers': set(), 'workers': set()}  # channels we asked publishes for
+channels_lock   = threading.Lock()
+
+# echo probes passed on to another server, waiting for the answer
+probes      = {}  # probe sequence number and send time -> connection it came from
+probes_lock = threading.Lock()
+
+# attempt handshakes with everyone (servers), except ourselves.
+# the other workers learn about those servers from the first one
+for p in shared._PORTS if worker_index == 0 else ():
     if p == shared._PORTS[port_index]:
         continue
     addr = (shared._LOCALHOST, p)
-    conn = shared.attempt_handshake(*addr)
+    conn = shared.attempt_handshake(*addr, args.nodelay)
     # if establised a connection with another server
     if conn is not None:
         # register the server
-        servers[addr] = conn
+        tune_socket(conn)
+        register_server(addr, conn)
         shared.set_username(conn, str(shared._PORTS[port_index]), False)
+        share_interest(conn)
 
         # request the active servers list
         shared.LOG_MESSAGE(f'requesting server list from {addr}.')
-        addresses = request_servers(conn)
+        addresses = request_servers(conn, addr)
 
         # if failed retrieving connections, resort to iterational connections
         if addresses is None:
@@ -199,23 +1128,53 @@ for p in shared._PORTS:
         connect_to_servers(addresses)
         break
 
-# discard any failed connections
-servers = {addr:sock for addr, sock in servers.items() if sock is not None}
+# learn which clients can be reached through each server, the answers are
+# picked up once the connections are being served
+if args.directory == 'hash':
+    update_ring()
+else:
+    for sock in connections.server_connections():
+        shared.request_clients(sock)
 
-# open threads for active connections
-for addr, sock in servers.items():
-    threading.Thread(target=respond_to_connection, args=(sock, addr)).start()
+# metrics, each worker serves its own socket
+register_gauges()
+if args.metrics_socket:
+    path = args.metrics_socket if worker_index == 0 else f'{args.metrics_socket}.{worker_index}'
+    threading.Thread(target=serve_metrics, args=(path,), daemon=True).start()
 
 # listener setup
-listener = setup_listener(shared._PORTS[port_index])
-await_connections(listener)
+listener = setup_listener(shared._PORTS[port_index], args.workers > 1)
+
+if args.engine == 'asyncio':
+    raise_file_limit()
+    try:
+        asyncio.run(serve_async(listener))
+    except KeyboardInterrupt:
+        pass
+else:
+    # open threads for active connections
+    for addr, sock in connections.server_items():
+        conn = queue_connection(sock)
+        connections.add_server(addr, conn)
+        shared.send_offer(conn, shared._COMPRESS_OFFER)
+        threading.Thread(target=respond_to_connection, args=(conn, addr)).start()
+
+    # and for the links with the sibling workers
+    for index, sock in connections.worker_items():
+        conn = queue_connection(sock)
+        connections.add_worker(index, conn)
+        threading.Thread(target=respond_to_connection, args=(conn, ('worker', index))).start()
+
+    if reap_period():
+        threading.Thread(target=reap_connections, daemon=True).start()
+    await_connections(listener)
 
 # disconnect from clients
-for client in clients.values():
+for client in connections.client_connections():
     client.close()
 
 # disconnect from servers
-for server in servers.values():
+for server in connections.server_connections():
     server.close()
 
 shared.LOG_MESSAGE('done.')
@@ -1,4 +1,5 @@
-import socket, struct
+import os, socket, struct, time
+import compress, log, metrics
 
 # ANSI escape codes
 class ANSI:
@@ -16,6 +17,86 @@ _LOCALHOST = '127.0.0.1'
 _PORTS = [30000, 30001, 30002, 30003, 30004]
 _HEADER_FORMAT = '!BBHH'
 _HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_HEADER = struct.Struct(_HEADER_FORMAT)
+_MAX_FRAME_SIZE = _HEADER_SIZE + 0xFFFF
+_RECV_BUFFER_SIZE = 256 * 1024
+
+# client list operations, carried in the sub_len field of a client list answer
+_PRESENCE_SNAPSHOT = 0  # the full list of clients connected to the sender
+_PRESENCE_JOIN     = 1  # clients that registered with the sender
+_PRESENCE_LEAVE    = 2  # clients that disconnected from the sender
+
+# list answers are binary: servers as packed ipv4 address and port, clients as
+# length prefixed names. lists too long for one frame are split into chunks,
+# flagged in the sub_len field next to the operation.
+_LIST_OPERATION    = 0x00FF  # sub_len bits holding the operation
+_LIST_MORE         = 0x0100  # more chunks of the same list follow
+_LIST_CONTINUED    = 0x0200  # not the first chunk of the list
+_LIST_RELAYED      = 0x0400  # reachable through the sender, but not connected to it
+_SERVER_ENTRY      = struct.Struct('!4sH')
+_NAME_LENGTH       = struct.Struct('!H')
+
+# directory sub types, used when usernames are located through a consistent hash ring
+_DIRECTORY_REGISTER   = 0  # username\0location, stored by the owner of the username
+_DIRECTORY_UNREGISTER = 1  # username\0location, removed by the owner if still current
+_DIRECTORY_LOOKUP     = 2  # username, asks the owner where the user is connected
+_DIRECTORY_ANSWER     = 3  # username\0location, with an empty location if unknown
+
+# message sub type flags
+_MESSAGE_DIRECT    = 0x00  # sent by a client, or routed to the server holding the recipient
+_MESSAGE_FLOODED   = 0x01  # broadcast to every server after a routing miss
+_MESSAGE_STREAM    = 0x02  # a chunk of a streamed body
+_MESSAGE_OFFLINE   = 0x04  # for a recipient connected nowhere, kept by the owner of its directory record
+
+# streamed bodies are sent as a series of messages, each carrying a stream header
+# (stream id, flags) before its chunk, so servers forward them chunk by chunk
+# without ever holding the whole body
+_STREAM_HEADER     = struct.Struct('!IB')
+_STREAM_FIRST      = 0x01
+_STREAM_LAST       = 0x02
+_STREAM_CHUNK_SIZE = 16 * 1024
+
+# echo probe sub types. a probe carries its sequence number, send time and the number
+# of servers it passed, followed by the node id of the server that should answer it
+# (empty for the first server). the reply carries the probe back unchanged
+_PROBE_REQUEST     = 0
+_PROBE_REPLY       = 1
+_PROBE_UNREACHABLE = 2  # the target server is not connected to the server the probe reached
+_PROBE             = struct.Struct('!IQB')
+_PROBE_PENDING_LIMIT = 4096  # probes a server passed on and still waits to answer
+
+# channel sub types. clients subscribe and unsubscribe with the channel name, and publish
+# sender\0channel\0message with the channel length in sub_len, like a direct message.
+# servers tell each other which channels they want publishes for with name lists,
+# chunked and flagged like presence lists
+_CHANNEL_SUBSCRIBE   = 0
+_CHANNEL_UNSUBSCRIBE = 1
+_CHANNEL_PUBLISH     = 2
+_CHANNEL_INTEREST    = 3
+_CHANNEL_OPERATION   = 0x0F  # sub type bits holding the operation
+_CHANNEL_RELAYED     = 0x80  # a publish that came from another server, it isn't sent to servers again
+
+# heartbeat sub types. a connection that went quiet is pinged, and answered with a pong,
+# so a live but idle peer never reaches the idle timeout
+_HEARTBEAT_PING     = 0
+_HEARTBEAT_PONG     = 1
+_HEARTBEAT_INTERVAL = 10.0  # seconds of silence before a connection is pinged
+_IDLE_TIMEOUT       = 30.0  # seconds of silence before a connection is closed
+
+# compression. a connection offers the codecs it decodes (compress.DEFLATE, ...) as the
+# payload, with the id of its preset dictionary in sub_len, and offers are answered with
+# the other end's. a compressed frame has these bits set in its type, its len is the
+# compressed length and sub_len still counts into the payload once it was inflated
+_COMPRESS_OFFER      = 0
+_COMPRESS_ANSWER     = 1
+_COMPRESSED          = 0x80  # type bit: the payload is deflated
+_COMPRESSED_DICT     = 0x40  # type bit: deflated with the preset dictionary
+_TYPE                = 0x3F  # type bits holding the type
+
+# tcp keepalive, for peers that vanish without closing the connection
+_KEEPALIVE_IDLE     = 30  # seconds of silence before the kernel probes
+_KEEPALIVE_INTERVAL = 5   # seconds between unanswered probes
+_KEEPALIVE_COUNT    = 3   # unanswered probes before the connection is dropped
 
 # shared methods
 def port_select(ports: list) -> int:
@@ -35,16 +116,38 @@ def port_select(ports: list) -> int:
         port_index = port_input()
     return port_index
 
+# written by the background log writer, see log.py
 def LOG_MESSAGE(message: str) -> None:
-    print(f'{ANSI.YELLOW}LOG: {message}{ANSI.RESET}')
+    log.logger.info(message)
 
 def LOG_ERROR(message: str) -> None:
-    print(f'{ANSI.RED}ERROR: {message}{ANSI.RESET}')
+    log.logger.error(message)
 
-def attempt_handshake(ip: str, port: int) -> socket.socket:
+def set_nodelay(sock: socket.socket, enabled: bool = True) -> None:
+    # disable nagle's algorithm, so small messages leave right away instead of waiting for acks
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+    except OSError as err:
+        LOG_ERROR(f'could not set TCP_NODELAY.\n\t{err}')
+
+def set_keepalive(sock: socket.socket, idle: int = _KEEPALIVE_IDLE, interval: int = _KEEPALIVE_INTERVAL,
+                  count: int = _KEEPALIVE_COUNT) -> None:
+    # have the kernel probe an idle connection and drop it after count unanswered probes.
+    # data left unacknowledged for as long drops it too, where TCP_USER_TIMEOUT exists
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count),
+                              ('TCP_USER_TIMEOUT', (idle + interval * count) * 1000)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+    except OSError as err:
+        LOG_ERROR(f'could not set tcp keepalive.\n\t{err}')
+
+def attempt_handshake(ip: str, port: int, nodelay: bool = True) -> socket.socket:
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         sock.connect((ip, port))
+        set_nodelay(sock, nodelay)
         LOG_MESSAGE(f'connection with {(ip, port)} established.')
         return sock
     except OSError as err:
@@ -80,90 +183,313 @@ def request_clients(server_sock: socket.socket) -> None:
     send_via_socket(server_sock, bytes_header)
     return
 
-def send_servers(server_sock: socket.socket, data: str) -> None:
+def encode_servers(addresses: list[tuple[str, int]]) -> list[bytes]:
+    return [_SERVER_ENTRY.pack(socket.inet_aton(ip), port) for ip, port in addresses]
+
+def decode_servers(payload: memoryview) -> list[tuple[str, int]]:
+    return [(socket.inet_ntoa(ip), port) for ip, port in _SERVER_ENTRY.iter_unpack(payload)]
+
+def encode_clients(usernames: list[str]) -> list[bytes]:
+    entries = []
+    for username in usernames:
+        bytes_username = username.encode()
+        entries.append(_NAME_LENGTH.pack(len(bytes_username)) + bytes_username)
+    return entries
+
+def decode_clients(payload: memoryview) -> list[str]:
+    usernames = []
+    offset = 0
+    while offset + _NAME_LENGTH.size <= len(payload):
+        (length,) = _NAME_LENGTH.unpack_from(payload, offset)
+        offset += _NAME_LENGTH.size
+        usernames.append(decode(payload[offset:offset + length]))
+        offset += length
+    return usernames
+
+def list_frames(_type: int, _sub_type: int, entries: list[bytes], operation: int = 0) -> list[bytes]:
+    # pack encoded entries into as few frames as fit, an empty list is still one frame
+    chunks = [[]]
+    size = 0
+    for entry in entries:
+        if size + len(entry) > 0xFFFF:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(entry)
+        size += len(entry)
+
+    frames = []
+    for index, chunk in enumerate(chunks):
+        bytes_data = b''.join(chunk)
+        flags = (_LIST_MORE if index < len(chunks) - 1 else 0) | (_LIST_CONTINUED if index > 0 else 0)
+        frames.append(struct.pack(_HEADER_FORMAT, _type, _sub_type, len(bytes_data), operation | flags) + bytes_data)
+    return frames
+
+def send_servers(server_sock: socket.socket, addresses: list[tuple[str, int]]) -> None:
+    # prepare and send the list, chunked if necessary
+    for frame in list_frames(1, 0, encode_servers(addresses)):
+        send_via_socket(server_sock, frame)
+    return
+
+def send_clients(server_sock: socket.socket, usernames: list[str], operation: int = _PRESENCE_SNAPSHOT) -> None:
+    # prepare and send the list, chunked if necessary
+    for frame in list_frames(1, 1, encode_clients(usernames), operation):
+        send_via_socket(server_sock, frame)
+    return
+
+def set_username(server_sock: socket.socket, data: str, client: bool) -> None:
     # prepare data segment
-    bytes_data  = data.encode()
+    bytes_username   = data.encode()
 
     # prepare header values
-    _type       = 1
-    _sub_type   = 0
-    _len        = len(bytes_data)
+    _type       = 2
+    _sub_type   = 1 if client else 0
+    _len        = len(bytes_username)
     _sub_len    = 0
 
     # construct header
     bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
 
     # send header & data
-    send_via_socket(server_sock, bytes_header, bytes_data)
+    send_via_socket(server_sock, bytes_header, bytes_username)
     return
 
-def send_clients(server_sock: socket.socket, data: str) -> None:
+def send_message(server_sock: socket.socket, sender: str, recipient: str, data: str) -> None:
     # prepare data segment
-    bytes_data  = data.encode()
+    bytes_recipient = recipient.encode()
+    message         = f'{sender}\0{recipient}\0{data}'
+    bytes_message   = message.encode()
 
     # prepare header values
-    _type       = 1
-    _sub_type   = 1
-    _len        = len(bytes_data)
-    _sub_len    = 0
+    _type       = 3
+    _sub_type   = 0
+    _len        = len(bytes_message)
+    _sub_len    = len(bytes_recipient)
 
     # construct header
     bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
 
     # send header & data
-    send_via_socket(server_sock, bytes_header, bytes_data)
+    send_via_socket(server_sock, bytes_header, bytes_message)
     return
 
-def set_username(server_sock: socket.socket, data: str, client: bool) -> None:
+def send_channel(server_sock: socket.socket, sub_type: int, channel: str) -> None:
+    # subscribe to or unsubscribe from a channel
+    bytes_channel = channel.encode()
+    send_via_socket(server_sock, pack_header(8, sub_type, len(bytes_channel), 0), bytes_channel)
+
+def send_publish(server_sock: socket.socket, sender: str, channel: str, data: str) -> None:
+    # prepare data segment, laid out like a direct message
+    bytes_channel = channel.encode()
+    bytes_message = f'{sender}\0{channel}\0{data}'.encode()
+
+    # prepare header values
+    _type       = 8
+    _sub_type   = _CHANNEL_PUBLISH
+    _len        = len(bytes_message)
+    _sub_len    = len(bytes_channel)
+
+    # construct header
+    bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
+
+    # send header & data
+    send_via_socket(server_sock, bytes_header, bytes_message)
+    return
+
+def send_stream(server_sock: socket.socket, sender: str, recipient: str, source,
+                stream_id: int = None, chunk_size: int = _STREAM_CHUNK_SIZE) -> int:
+    # source is a binary file object, only one chunk of it is read at a time
+    bytes_recipient = recipient.encode()
+    bytes_prefix    = f'{sender}\0{recipient}\0'.encode()
+    if stream_id is None:
+        stream_id = int.from_bytes(os.urandom(4), 'big')
+
+    # keep every chunk, prefix and stream header included, within one frame
+    chunk_size = min(chunk_size, 0xFFFF - len(bytes_prefix) - _STREAM_HEADER.size)
+    if chunk_size <= 0:
+        raise ValueError('sender and recipient names leave no room for data')
+
+    # read one chunk ahead, so the last one can be flagged
+    sent  = 0
+    flags = _STREAM_FIRST
+    chunk = source.read(chunk_size)
+    while True:
+        next_chunk = source.read(chunk_size) if chunk else b''
+        if not next_chunk:
+            flags |= _STREAM_LAST
+
+        # prepare data segment
+        bytes_stream = _STREAM_HEADER.pack(stream_id, flags)
+
+        # prepare header values
+        _type       = 3
+        _sub_type   = _MESSAGE_STREAM
+        _len        = len(bytes_prefix) + len(bytes_stream) + len(chunk)
+        _sub_len    = len(bytes_recipient)
+
+        # construct header
+        bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
+
+        # send header & data in one write
+        send_buffers(server_sock, [bytes_header, bytes_prefix, bytes_stream, chunk])
+        sent += len(chunk)
+
+        if flags & _STREAM_LAST:
+            return sent
+        flags = 0
+        chunk = next_chunk
+
+def unpack_stream_chunk(payload: memoryview, recipient_len: int) -> tuple[str, str, int, int, memoryview]:
+    # a chunk payload is sender\0recipient\0 followed by the stream header and the data
+    sender_end = find_separator(payload)
+    if sender_end == -1:
+        raise ValueError('malformed stream payload')
+    recipient_end = sender_end + 1 + recipient_len
+    stream_id, flags = _STREAM_HEADER.unpack_from(payload, recipient_end + 1)
+    return (decode(payload[:sender_end]), decode(payload[sender_end + 1:recipient_end]),
+            stream_id, flags, payload[recipient_end + 1 + _STREAM_HEADER.size:])
+
+def send_directory(server_sock: socket.socket, sub_type: int, data: str) -> None:
     # prepare data segment
-    bytes_username   = data.encode()
+    bytes_data  = data.encode()
 
     # prepare header values
-    _type       = 2
-    _sub_type   = 1 if client else 0
-    _len        = len(bytes_username)
+    _type       = 5
+    _sub_type   = sub_type
+    _len        = len(bytes_data)
     _sub_len    = 0
 
     # construct header
     bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
 
     # send header & data
-    send_via_socket(server_sock, bytes_header, bytes_username)
+    send_via_socket(server_sock, bytes_header, bytes_data)
     return
 
-def send_message(server_sock: socket.socket, sender: str, recipient: str, data: str) -> None:
-    # prepare data segment
-    bytes_recipient = recipient.encode()
-    message         = f'{sender}\0{recipient}\0{data}'
-    bytes_message   = message.encode()
+def send_probe(server_sock: socket.socket, seq: int, target: str = '', size: int = 0) -> None:
+    # prepare data segment, padded to size
+    bytes_target = target.encode()
+    bytes_data   = (_PROBE.pack(seq, time.perf_counter_ns(), 0) + bytes_target).ljust(size, b'\0')
 
     # prepare header values
-    _type       = 3
-    _sub_type   = 0
-    _len        = len(bytes_message)
-    _sub_len    = len(bytes_recipient)
+    _type       = 4
+    _sub_type   = _PROBE_REQUEST
+    _len        = len(bytes_data)
+    _sub_len    = len(bytes_target)
 
     # construct header
     bytes_header = struct.pack(_HEADER_FORMAT, _type, _sub_type, _len, _sub_len)
 
     # send header & data
-    send_via_socket(server_sock, bytes_header, bytes_message)
+    send_via_socket(server_sock, bytes_header, bytes_data)
     return
 
-def send_via_socket(sock: socket.socket, header: bytes, data: bytes = None) -> None:
+def send_heartbeat(sock: socket.socket, sub_type: int) -> bool:
+    return send_via_socket(sock, pack_header(7, sub_type, 0, 0))
+
+def send_offer(sock: socket.socket, sub_type: int) -> bool:
+    # the codecs we decode, only if we compress too
+    if not compress.compression.enabled:
+        return False
+    codecs = compress.compression.codecs()
+    return send_via_socket(sock, pack_header(9, sub_type, len(codecs), compress.compression.dictionary_id), codecs)
+
+def unpack_probe(payload: memoryview, target_len: int) -> tuple[int, int, int, str]:
+    # sequence number, send time, servers passed and target of a probe
+    seq, sent_ns, hops = _PROBE.unpack_from(payload)
+    return seq, sent_ns, hops, decode(payload[_PROBE.size:_PROBE.size + target_len])
+
+def probe_summary(rtts: list[int], sent: int) -> dict:
+    # statistics of a probe run, rtts in ns and in sequence order. jitter is the mean
+    # difference between consecutive rtts
+    summary = {'sent': sent, 'received': len(rtts), 'loss': (sent - len(rtts)) / sent if sent else 0.0}
+    if not rtts:
+        return summary
+
+    ordered = sorted(rtts)
+    rank = lambda p: ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+    jitter = sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1) if len(rtts) > 1 else 0
+    summary.update({
+        'min_ms':    ordered[0] / 1e6,
+        'avg_ms':    sum(rtts) / len(rtts) / 1e6,
+        'max_ms':    ordered[-1] / 1e6,
+        'jitter_ms': jitter / 1e6,
+        'p50_ms':    rank(50) / 1e6,
+        'p90_ms':    rank(90) / 1e6,
+        'p99_ms':    rank(99) / 1e6,
+    })
+    return summary
+
+def send_via_socket(sock: socket.socket, header: bytes, data: bytes = None) -> bool:
+    # returns whether the message could be sent (or queued). header may hold the whole frame
+    buffers = [header] if not data else [header, data]
     try:
-        sock.send(header)
+        if compress.compression.peers:
+            buffers = compress_frame(sock, header, data) or buffers
+        send_buffers(sock, buffers)
+        metrics.frames_out.inc(header[0])
+        metrics.bytes_out.inc(header[0], len(header) + (len(data) if data else 0))
+        return True
     except Exception as err:
-        LOG_ERROR(f'an error occurred while sending message header.\n\t{err}')
-        return
+        LOG_ERROR(f'an error occurred while sending message.\n\t{err}')
+        return False
 
-    if data is None:
-        return
+def compress_frame(sock: socket.socket, header: bytes, data: bytes = None) -> list:
+    # the frame deflated for sock, or None when it goes out as it is
+    payload = data if data else memoryview(header)[_HEADER_SIZE:]
+    if len(payload) == 0 or header[0] == 9:
+        return None
+    deflated = compress.compression.deflate(sock, payload, data if data else header)
+    if deflated is None:
+        return None
+
+    compressed, dictionary = deflated
+    _type, _sub_type, _, _sub_len = _HEADER.unpack_from(header)
+    _type |= _COMPRESSED | (_COMPRESSED_DICT if dictionary else 0)
+    return [pack_header(_type, _sub_type, len(compressed), _sub_len), compressed]
 
+def inflate_frame(header: tuple, payload: memoryview) -> tuple[tuple, memoryview]:
+    # a received frame as it was before it was compressed
+    _type, _sub_type, _, _sub_len = header
+    try:
+        data = compress.compression.inflate(payload, bool(_type & _COMPRESSED_DICT))
+    except ValueError as err:
+        raise ConnectionAbortedError(f'could not decompress a frame: {err}') from None
+    return (_type & _TYPE, _sub_type, len(data), _sub_len), memoryview(data)
+
+def send_stored(sock: socket.socket, frames: list) -> bool:
+    # frames handed out by the offline store, sent from its segment files without copying
+    # them. outbound connections queue them for their writer, plain sockets get slices of
+    # the mapping. returns whether they could all be sent (or queued)
     try:
-        sock.send(data)
+        if hasattr(sock, 'replay'):
+            sock.replay(frames)
+        else:
+            for frame in frames:
+                send_buffers(sock, [frame.view()])
+        metrics.frames_out.inc(3, len(frames))
+        metrics.bytes_out.inc(3, sum(len(frame) for frame in frames))
+        return True
     except Exception as err:
-        LOG_ERROR(f'an error occurred while sending message data.\n\t{err}')
+        LOG_ERROR(f'an error occurred while sending stored messages.\n\t{err}')
+        return False
+
+def send_buffers(sock: socket.socket, buffers: list) -> None:
+    # without sendmsg (windows) join the buffers and send them in one go
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+
+    # a single vectored write per message, resume after short writes
+    buffers = list(buffers)
+    sent = sock.sendmsg(buffers)
+    total = sum(len(buffer) for buffer in buffers)
+    while sent < total:
+        total -= sent
+        # skip the buffers that were sent whole, and trim the one that was cut
+        while sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        buffers[0] = memoryview(buffers[0])[sent:]
+        sent = sock.sendmsg(buffers)
 
 def receive_via_socket(sock: socket.socket) -> dict:
     response = {
@@ -179,11 +505,9 @@ def receive_via_socket(sock: socket.socket) -> dict:
 
     # receive header bytes
     try:
-        bytes_header = sock.recv(_HEADER_SIZE)
-        if len(bytes_header) == 0:
-            raise ConnectionResetError
+        bytes_header = recv_exactly(sock, _HEADER_SIZE)
         response['bytes_header'] = bytes_header
-        _type, _sub_type, _len, _sub_len = struct.unpack(_HEADER_FORMAT, bytes_header)
+        _type, _sub_type, _len, _sub_len = _HEADER.unpack(bytes_header)
         response['type']     = _type
         response['sub_type'] = _sub_type
         response['len']      = _len
@@ -198,14 +522,102 @@ def receive_via_socket(sock: socket.socket) -> dict:
 
     # receive data bytes
     try:
-        bytes_data = sock.recv(_len)
-        if len(bytes_data) == 0:
-            raise ConnectionResetError
+        bytes_data = recv_exactly(sock, _len)
+        if _type & _COMPRESSED:
+            header, payload = inflate_frame((_type, _sub_type, _len, _sub_len), bytes_data)
+            bytes_header, bytes_data = pack_header(*header), bytes(payload)
+            response.update(bytes_header=bytes_header, type=header[0], len=header[2])
         response['bytes_data']  = bytes_data
-        data       = bytes_data.decode()
-        response['data']  = data
     except Exception as err:
         LOG_ERROR(f'an error occurred while retrieving message data.\n\t{err}')
+        response['error']  = err
         return response
-    
+
+    # text payloads are decoded for convenience, list answers are binary
+    try:
+        response['data'] = bytes_data.decode()
+    except UnicodeDecodeError:
+        pass
+
     return response
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    # tcp may deliver a message over several segments, keep reading until it is whole
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionResetError
+        received += n
+    return bytes(data)
+
+class FrameReader:
+    # buffered frame decoder: reads into one reusable buffer with recv_into and
+    # yields (header, payload) pairs, where header is the unpacked header tuple and
+    # payload is a memoryview into the buffer. a payload is only valid until the
+    # next frame is pulled, copy it (bytes(payload)) to keep it around.
+    def __init__(self, sock: socket.socket, size: int = _RECV_BUFFER_SIZE) -> None:
+        self.sock   = sock
+        # room for two whole frames, so moving a partial frame never overlaps itself
+        self.buffer = bytearray(max(size, 2 * _MAX_FRAME_SIZE))
+        self.view   = memoryview(self.buffer)
+        self.start  = 0  # first byte not yet handed out
+        self.end    = 0  # end of the received bytes
+
+    def _fill(self, size: int) -> None:
+        # make sure at least size unconsumed bytes are buffered
+        while self.end - self.start < size:
+            # move the partial frame to the front when it would not fit in the tail
+            if self.start + size > len(self.buffer):
+                pending = self.end - self.start
+                self.buffer[:pending] = self.view[self.start:self.end]
+                self.start, self.end = 0, pending
+
+            n = self.sock.recv_into(self.view[self.end:])
+            if n == 0:
+                raise ConnectionResetError
+            self.end += n
+
+    def frames(self):
+        while True:
+            # everything handed out has been consumed, restart at the front
+            if self.start == self.end:
+                self.start = self.end = 0
+
+            self._fill(_HEADER_SIZE)
+            header = _HEADER.unpack_from(self.buffer, self.start)
+
+            self._fill(_HEADER_SIZE + header[2])
+            payload_start = self.start + _HEADER_SIZE
+            self.start = payload_start + header[2]
+            if header[0] & _COMPRESSED:
+                yield inflate_frame(header, self.view[payload_start:self.start])
+            else:
+                yield header, self.view[payload_start:self.start]
+
+def pack_header(_type: int, _sub_type: int, _len: int, _sub_len: int) -> bytes:
+    return _HEADER.pack(_type, _sub_type, _len, _sub_len)
+
+def decode(payload: memoryview) -> str:
+    return str(payload, 'utf-8')
+
+def find_separator(payload: memoryview, start: int = 0) -> int:
+    # look for the next '\0' in growing slices, so only the bytes up to it get copied
+    step = 64
+    while start < len(payload):
+        index = bytes(payload[start:start + step]).find(0)
+        if index != -1:
+            return start + index
+        start += step
+        step *= 2
+    return -1
+
+def unpack_recipient(payload: memoryview, recipient_len: int) -> str:
+    # a message payload is sender\0recipient\0data, with the recipient length in the header,
+    # so the recipient can be read without decoding the message body
+    sender_end = find_separator(payload)
+    if sender_end == -1:
+        raise ValueError('malformed message payload')
+    return decode(payload[sender_end + 1:sender_end + 1 + recipient_len])
@@ -0,0 +1,242 @@
+import mmap, os, struct, threading, time
+
+# defaults
+_SEGMENT_SIZE    = 16 * 1024 * 1024  # bytes written to a segment before the next one is started
+_COMMIT_INTERVAL = 0.005             # seconds between fsyncs, 0 syncs every write
+
+# a record is its kind, the recipient and frame lengths, the recipient, then the frame
+_RECORD    = struct.Struct('!BHI')
+_MESSAGE   = 0  # a wire frame waiting for its recipient
+_DELIVERED = 1  # every earlier message of the recipient was handed out, no frame
+
+class Segment:
+    # a segment file opened for reading and mapped into memory. the mapping is redone when
+    # a frame past its end is wanted, the segment being written only ever grows. the file
+    # stays open while any of its frames is, even after the segment was deleted
+    def __init__(self, path: str) -> None:
+        self.fd  = os.open(path, os.O_RDONLY)
+        self.map = None
+
+    def mapping(self, end: int) -> mmap.mmap:
+        # called with the store lock held. older mappings stay valid for the frames using them
+        if self.map is None or len(self.map) < end:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def __del__(self) -> None:
+        os.close(self.fd)
+
+class StoredFrame:
+    # a frame handed out by the store, still in its segment file. it's sent from there,
+    # with os.sendfile from the descriptor or as a slice of the mapping, so replaying a
+    # backlog never copies the frames into python objects
+    __slots__ = ('segment', 'map', 'fd', 'offset', 'length')
+
+    def __init__(self, segment: Segment, offset: int, length: int) -> None:
+        self.segment = segment
+        self.map     = segment.mapping(offset + length)
+        self.fd      = segment.fd
+        self.offset  = offset
+        self.length  = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def view(self) -> memoryview:
+        return memoryview(self.map)[self.offset:self.offset + self.length]
+
+class MessageStore:
+    # messages for recipients that aren't connected anywhere, in an append-only log of
+    # numbered segment files with an in-memory index by recipient. records are only ever
+    # appended: taking a recipient's messages appends a delivered record, and a segment
+    # is deleted once it and every older segment hold no waiting messages, so a replay
+    # after a restart never brings delivered messages back.
+    #
+    # writes are group committed: a committer thread fsyncs whatever was written every
+    # commit interval, so a burst of messages shares one fsync instead of paying for one
+    # each. a crash loses at most the last interval. with an interval of 0 every write
+    # is synced before it returns.
+    def __init__(self, path: str, segment_size: int = _SEGMENT_SIZE, commit_interval: float = _COMMIT_INTERVAL) -> None:
+        self.path            = path
+        self.segment_size    = segment_size
+        self.commit_interval = commit_interval
+        self.index           = {}  # recipient -> [(segment, frame offset, frame length)]
+        self.live            = {}  # segment -> messages in it still waiting
+        self.segments        = []  # segment numbers, oldest first
+        self.readers         = {}  # segment -> Segment, opened by the first take from it
+        self.lock            = threading.Lock()
+        self.fd              = None
+        self.offset          = 0
+        self.retired         = []  # descriptors of full segments, closed after their last fsync
+        self.dirty           = False
+
+        # counters
+        self.stored    = 0
+        self.delivered = 0
+        self.commits   = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._recover()
+        self._open_segment((self.segments[-1] + 1) if self.segments else 0)
+
+        if commit_interval > 0:
+            threading.Thread(target=self._commit, daemon=True).start()
+
+    # messages
+    def put(self, recipient: str, frame: bytes) -> None:
+        bytes_recipient = recipient.encode()
+        with self.lock:
+            if self.offset >= self.segment_size:
+                self._rotate()
+            offset = self.offset + _RECORD.size + len(bytes_recipient)
+            self._write(_RECORD.pack(_MESSAGE, len(bytes_recipient), len(frame)) + bytes_recipient + frame)
+            self.index.setdefault(recipient, []).append((self.segments[-1], offset, len(frame)))
+            self.live[self.segments[-1]] += 1
+            self.stored += 1
+
+    def has(self, recipient: str) -> bool:
+        return recipient in self.index
+
+    def take(self, recipient: str) -> list[StoredFrame]:
+        # the recipient's waiting frames, oldest first, and forget them. they stay readable
+        # until sent, even when their segment is deleted meanwhile
+        with self.lock:
+            entries = self.index.pop(recipient, None)
+            if not entries:
+                return []
+
+            frames = self._read(entries)
+            bytes_recipient = recipient.encode()
+            if self.offset >= self.segment_size:
+                self._rotate()
+            self._write(_RECORD.pack(_DELIVERED, len(bytes_recipient), 0) + bytes_recipient)
+            for segment, _, _ in entries:
+                self.live[segment] -= 1
+            self.delivered += len(frames)
+            self._collect()
+            return frames
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'waiting':    sum(len(entries) for entries in self.index.values()),
+                'recipients': len(self.index),
+                'segments':   len(self.segments),
+                'stored':     self.stored,
+                'delivered':  self.delivered,
+                'commits':    self.commits,
+            }
+
+    # segments
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f'{segment:08d}.log')
+
+    def _open_segment(self, segment: int) -> None:
+        self.fd = os.open(self._segment_path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.offset = 0
+        self.segments.append(segment)
+        self.live[segment] = 0
+        self._sync_directory()
+
+    def _rotate(self) -> None:
+        # called with the lock held, the committer syncs and closes the full segment
+        if self.commit_interval > 0:
+            self.retired.append(self.fd)
+        else:
+            os.close(self.fd)
+        self._open_segment(self.segments[-1] + 1)
+
+    def _write(self, record: bytes) -> None:
+        os.write(self.fd, record)
+        self.offset += len(record)
+        if self.commit_interval > 0:
+            self.dirty = True
+        else:
+            os.fsync(self.fd)
+            self.commits += 1
+
+    def _read(self, entries: list[tuple[int, int, int]]) -> list[StoredFrame]:
+        frames = []
+        for segment, offset, length in entries:
+            reader = self.readers.get(segment)
+            if reader is None:
+                reader = self.readers[segment] = Segment(self._segment_path(segment))
+            frames.append(StoredFrame(reader, offset, length))
+        return frames
+
+    def _collect(self) -> None:
+        # delete drained segments, oldest first so no delivered record outlives what it covers
+        while len(self.segments) > 1 and self.live[self.segments[0]] == 0:
+            segment = self.segments.pop(0)
+            del self.live[segment]
+            self.readers.pop(segment, None)
+            try:
+                os.unlink(self._segment_path(segment))
+            except OSError:
+                pass
+
+    def _commit(self) -> None:
+        while True:
+            time.sleep(self.commit_interval)
+            with self.lock:
+                if not self.dirty and not self.retired:
+                    continue
+                fds, self.retired = self.retired, []
+                current = self.fd if self.dirty else None
+                self.dirty = False
+
+            # sync outside the lock, writers keep appending meanwhile
+            for fd in fds:
+                os.fsync(fd)
+                os.close(fd)
+            if current is not None:
+                try:
+                    os.fsync(current)
+                except OSError:
+                    pass
+            self.commits += 1
+
+    def _sync_directory(self) -> None:
+        # make the new segment's directory entry durable too, where directories can be opened
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _recover(self) -> None:
+        # rebuild the index from the segments left by a previous run. a record cut short
+        # by a crash ends its segment, the writes after a restart go to a new one
+        names = sorted(name for name in os.listdir(self.path) if name.endswith('.log') and name[:-4].isdigit())
+        for name in names:
+            segment = int(name[:-4])
+            self.segments.append(segment)
+            self.live[segment] = 0
+            # scanned through a mapping, the segment isn't read into memory
+            with open(os.path.join(self.path, name), 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    continue
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            offset = 0
+            while offset + _RECORD.size <= len(data):
+                kind, recipient_len, frame_len = _RECORD.unpack_from(data, offset)
+                end = offset + _RECORD.size + recipient_len + frame_len
+                if end > len(data):
+                    break
+                recipient = data[offset + _RECORD.size:offset + _RECORD.size + recipient_len].decode()
+                if kind == _MESSAGE:
+                    self.index.setdefault(recipient, []).append((segment, end - frame_len, frame_len))
+                    self.live[segment] += 1
+                else:
+                    for entry_segment, _, _ in self.index.pop(recipient, ()):
+                        self.live[entry_segment] -= 1
+                offset = end
+            data.close()
+
+        self._collect()
@@ -1,8 +1,16 @@
 from threading import Thread
+import argparse
 import socket
 import sys
+import rudp
+parser = argparse.ArgumentParser()
+parser.add_argument('--reliable', action='store_true',
+                    help='number, ack and retransmit every datagram, the server needs --reliable too')
+args = parser.parse_args()
 server_addr = ('127.0.0.1', 9999)
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+if args.reliable:
+    sock = rudp.Endpoint(sock)
 my_name = input('Enter your name: ')
 sock.sendto(my_name.encode(), server_addr)
 def output_recvfrom(sock):
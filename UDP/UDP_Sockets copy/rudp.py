@@ -0,0 +1,304 @@
+import collections, heapq, os, socket, struct, threading, time
+
+# reliable delivery over a udp socket. every datagram carries a sequence number and is
+# kept until the peer acknowledges it. acks are cumulative, with selective ack blocks for
+# what arrived past a gap, a sliding window bounds the datagrams in flight per peer, the
+# retransmit timer follows RFC 6298 and duplicates are recognised by their sequence.
+# messages are handed over as they arrive, a gap doesn't hold back the ones after it.
+
+DATA = 0
+ACK  = 1
+
+# data: type, sender session, sequence, oldest sequence the sender still waits an ack for
+DATA_HEADER = struct.Struct('!BIII')
+HEADER_SIZE = DATA_HEADER.size
+# ack: type, session acked, every sequence below this arrived, number of blocks
+ACK_HEADER = struct.Struct('!BIIB')
+ACK_BLOCK  = struct.Struct('!II')  # first and past the last sequence of a run that arrived
+MAX_BLOCKS = 4
+
+WINDOW        = 64    # datagrams in flight per peer
+RECEIVE_AHEAD = 1024  # sequences past the first missing one a receiver keeps track of
+MAX_RETRIES   = 15    # retransmits of one datagram before the peer is given up on, as tcp
+DUP_THRESHOLD = 3     # acks for later datagrams before a missing one is resent right away
+POLL          = 0.1   # longest blocking wait, so timers run while another thread sends
+LINGER        = 5.0   # seconds close() waits for the last datagrams to be acked
+
+# RFC 6298 timer. the floor is below its 1 second, like most stacks use, a lost chat line
+# shouldn't take a second to come back
+INITIAL_RTO = 1.0
+MIN_RTO     = 0.2
+MAX_RTO     = 60.0
+ALPHA       = 1 / 8
+BETA        = 1 / 4
+GRANULARITY = 0.001
+
+class Sender:
+    # the datagrams we send one peer. a new session starts when a peer was given up on,
+    # its receiver then doesn't take the restarted sequences for duplicates
+    def __init__(self):
+        self.session   = int.from_bytes(os.urandom(4), 'big')
+        self.next_seq  = 0
+        self.in_flight = {}  # seq -> [data, sent at, retransmits, later ones acked, deadline], oldest first
+        self.waiting   = collections.deque()  # data that didn't fit in the window yet
+        self.srtt      = None
+        self.rttvar    = 0.0
+        self.rto       = INITIAL_RTO
+
+    def base(self):
+        return next(iter(self.in_flight), self.next_seq)
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt   = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(GRANULARITY, 4 * self.rttvar)))
+
+class Receiver:
+    # the datagrams one peer sends us, in a session of theirs
+    def __init__(self, session):
+        self.session    = session
+        self.cumulative = 0      # every sequence below arrived
+        self.received   = set()  # sequences past it that arrived
+        self.recent     = collections.deque(maxlen=MAX_BLOCKS)  # the latest of them, newest last
+
+    def accept(self, seq, base):
+        # whether the datagram is new. what the sender stopped waiting for can't come anymore
+        if base > self.cumulative:
+            self.cumulative = base
+            self.received = {s for s in self.received if s >= base}
+            self._advance()
+        if seq < self.cumulative or seq in self.received or seq >= self.cumulative + RECEIVE_AHEAD:
+            return False
+        self.received.add(seq)
+        self.recent.append(seq)
+        self._advance()
+        return True
+
+    def blocks(self):
+        # the runs past a gap holding the latest arrivals, newest first like RFC 2018 asks,
+        # so the sender hears about everything recent however many gaps there are
+        blocks = []
+        for seq in reversed(self.recent):
+            if seq < self.cumulative or any(start <= seq < end for start, end in blocks):
+                continue
+            start, end = seq, seq + 1
+            while start - 1 in self.received:
+                start -= 1
+            while end in self.received:
+                end += 1
+            blocks.append((start, end))
+        return blocks
+
+    def _advance(self):
+        while self.cumulative in self.received:
+            self.received.remove(self.cumulative)
+            self.cumulative += 1
+
+class Endpoint:
+    # wraps a udp socket with sendto and recvfrom that deliver reliably, for a blocking
+    # socket. a non-blocking one calls receive() for every datagram, flush_acks() after a
+    # batch, and retransmit() whenever timeout() runs out
+    def __init__(self, sock, window=WINDOW):
+        self.sock      = sock
+        self.window    = window
+        self.senders   = {}  # addr -> Sender
+        self.receivers = {}  # addr -> Receiver
+        self.timers    = []  # heap of (deadline, addr, seq)
+        self.acks      = set()  # peers we owe an ack
+        self.lock      = threading.RLock()
+        self.closed    = False
+
+        # counters
+        self.retransmits = 0
+        self.duplicates  = 0
+        self.given_up    = 0
+
+    # socket interface
+    def sendto(self, data, addr):
+        data = bytes(data)
+        with self.lock:
+            sender = self.senders.get(addr)
+            if sender is None:
+                sender = self.senders[addr] = Sender()
+            if len(sender.in_flight) < self.window:
+                self._send(sender, addr, data)
+            else:
+                sender.waiting.append(data)
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        # the next new message, acking and retransmitting meanwhile. b'' once closed
+        while not self.closed:
+            timeout = self.timeout()
+            try:
+                self.sock.settimeout(POLL if timeout is None else min(timeout, POLL))
+                packet, addr = self.sock.recvfrom(bufsize + HEADER_SIZE)
+            except (socket.timeout, BlockingIOError):
+                self.retransmit()
+                continue
+            except OSError:
+                if self.closed:
+                    break
+                raise
+
+            new = self.receive(packet, addr)
+            self.flush_acks()
+            self.retransmit()
+            if new:
+                return packet[HEADER_SIZE:], addr
+        return b'', None
+
+    def close(self):
+        # give the last datagrams a moment to be acked, a reader thread handles the acks
+        deadline = time.monotonic() + LINGER
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(POLL / 2)
+        self.closed = True
+        self.sock.close()
+
+    def pending(self):
+        with self.lock:
+            return sum(len(sender.in_flight) + len(sender.waiting) for sender in self.senders.values())
+
+    # datagrams
+    def receive(self, packet, addr):
+        # handles one datagram, returns whether it's a new message. its payload starts at HEADER_SIZE
+        if not packet:
+            return False
+        with self.lock:
+            if packet[0] == ACK:
+                self._acked(packet, addr)
+                return False
+            if packet[0] != DATA or len(packet) < HEADER_SIZE:
+                return False
+
+            _, session, seq, base = DATA_HEADER.unpack_from(packet)
+            receiver = self.receivers.get(addr)
+            if receiver is None or receiver.session != session:
+                # a new peer, or one that restarted
+                receiver = self.receivers[addr] = Receiver(session)
+            self.acks.add(addr)
+            if receiver.accept(seq, base):
+                return True
+            self.duplicates += 1
+            return False
+
+    def flush_acks(self):
+        # one ack per peer for everything received since the last flush
+        with self.lock:
+            for addr in self.acks:
+                receiver = self.receivers[addr]
+                blocks = receiver.blocks()
+                packet = ACK_HEADER.pack(ACK, receiver.session, receiver.cumulative, len(blocks))
+                packet += b''.join(ACK_BLOCK.pack(start, end) for start, end in blocks)
+                self._sendto(packet, addr)
+            self.acks.clear()
+
+    def timeout(self):
+        # seconds until the next retransmit, None when nothing is in flight
+        with self.lock:
+            while self.timers and not self._armed(self.timers[0]):
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return None
+            return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def retransmit(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                timer = heapq.heappop(self.timers)
+                if not self._armed(timer):
+                    continue
+                _, addr, seq = timer
+                sender = self.senders[addr]
+                entry = sender.in_flight[seq]
+                if entry[2] >= MAX_RETRIES:
+                    self._give_up(addr)
+                    continue
+                # back off once per expiry of the oldest datagram, not for each one behind it
+                if seq == sender.base():
+                    sender.rto = min(MAX_RTO, sender.rto * 2)
+                self._resend(sender, addr, seq, entry, now)
+
+    def _armed(self, timer):
+        deadline, addr, seq = timer
+        sender = self.senders.get(addr)
+        entry = sender.in_flight.get(seq) if sender is not None else None
+        return entry is not None and entry[4] == deadline
+
+    def _send(self, sender, addr, data):
+        now = time.monotonic()
+        seq = sender.next_seq
+        sender.next_seq += 1
+        entry = sender.in_flight[seq] = [data, now, 0, 0, now + sender.rto]
+        heapq.heappush(self.timers, (entry[4], addr, seq))
+        self._transmit(sender, addr, seq, data)
+
+    def _resend(self, sender, addr, seq, entry, now):
+        entry[1] = now
+        entry[2] += 1
+        entry[4] = now + sender.rto
+        heapq.heappush(self.timers, (entry[4], addr, seq))
+        self._transmit(sender, addr, seq, entry[0])
+        self.retransmits += 1
+
+    def _transmit(self, sender, addr, seq, data):
+        self._sendto(DATA_HEADER.pack(DATA, sender.session, seq, sender.base()) + data, addr)
+
+    def _sendto(self, packet, addr):
+        try:
+            self.sock.sendto(packet, addr)
+        except (BlockingIOError, socket.timeout):
+            # the send buffer is full, the timer resends it like any other loss
+            pass
+
+    def _acked(self, packet, addr):
+        if len(packet) < ACK_HEADER.size:
+            return
+        _, session, cumulative, count = ACK_HEADER.unpack_from(packet)
+        sender = self.senders.get(addr)
+        if sender is None or session != sender.session:
+            return
+
+        acked = [seq for seq in sender.in_flight if seq < cumulative]
+        count = min(count, (len(packet) - ACK_HEADER.size) // ACK_BLOCK.size)
+        for index in range(count):
+            start, end = ACK_BLOCK.unpack_from(packet, ACK_HEADER.size + index * ACK_BLOCK.size)
+            acked.extend(seq for seq in range(max(start, sender.base()), min(end, sender.next_seq))
+                         if seq in sender.in_flight)
+
+        now = time.monotonic()
+        highest = -1
+        for seq in acked:
+            entry = sender.in_flight.pop(seq, None)
+            if entry is None:
+                continue
+            # karn: a retransmitted datagram's ack can't tell which copy it was for
+            if entry[2] == 0:
+                sender.sample(now - entry[1])
+            highest = max(highest, seq)
+
+        # a datagram still missing after later ones were acked was probably lost, resend
+        # it without waiting for its timer. only once, a resent copy needs a round trip
+        for seq, entry in list(sender.in_flight.items()):
+            if seq > highest:
+                break
+            if entry[2]:
+                continue
+            entry[3] += 1
+            if entry[3] == DUP_THRESHOLD:
+                self._resend(sender, addr, seq, entry, now)
+
+        # the window moved
+        while sender.waiting and len(sender.in_flight) < self.window:
+            self._send(sender, addr, sender.waiting.popleft())
+
+    def _give_up(self, addr):
+        sender = self.senders.pop(addr)
+        lost = len(sender.in_flight) + len(sender.waiting)
+        self.given_up += lost
+        print(f"no acks from {addr[0]}:{addr[1]}, dropped {lost} messages")
@@ -1,24 +1,154 @@
-import socket
+import argparse, os, selectors, socket
+import rudp
 UDP_IP = '0.0.0.0'
 UDP_PORT = 9999
+BUFFER_SIZE = 1024
+# datagrams drained per wakeup in fast mode, each with its own preallocated buffer
+BATCH_SIZE = 64
+ERROR_MESSAGE = "sorry you can't sent message to this client "
 client_dict={}
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-sock.bind((UDP_IP, UDP_PORT))
-
-while True:
-    data, addr = sock.recvfrom(1024)
-    data = data.decode()
-    if data.find(' ')==-1:
-        # If the name does not exist we will add it to the dict
-        if data not in client_dict:
-            client_dict[data]=addr
-            print(data,"-->Connected to the server!!!")
-    else:
-        #If we entered the else
-        # then the message type is of a target customer and a message to him
-        target_customer,message=data.split(" ",1)
-        if target_customer not in client_dict:
-            error_message="sorry you can't sent message to this client "
-            sock.sendto(error_message.encode(), addr)
+
+def open_socket(reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+    if reuse_port:
+        # every worker binds the same port, the kernel spreads the senders between them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((UDP_IP, UDP_PORT))
+    return sock
+
+def serve(sock):
+    while True:
+        data, addr = sock.recvfrom(BUFFER_SIZE)
+        data = data.decode()
+        if data.find(' ')==-1:
+            # If the name does not exist we will add it to the dict
+            if data not in client_dict:
+                client_dict[data]=addr
+                print(data,"-->Connected to the server!!!")
+        else:
+            #If we entered the else
+            # then the message type is of a target customer and a message to him
+            target_customer,message=data.split(" ",1)
+            if target_customer not in client_dict:
+                sock.sendto(ERROR_MESSAGE.encode(), addr)
+            else:
+                sock.sendto(message.encode(),client_dict[target_customer])
+
+# fast mode: names are kept as bytes, only the prefix up to the first space is looked at
+# and message bodies are forwarded straight out of the receive buffers, never decoded.
+# reliable, every datagram goes through an endpoint, which acks a batch at once.
+def serve_fast(sock, siblings=(), inbox=None, reliable=False):
+    sock.setblocking(False)
+    endpoint = rudp.Endpoint(sock) if reliable else None
+    # room for the reliable header too, messages get the same BUFFER_SIZE either way
+    size = BUFFER_SIZE + rudp.HEADER_SIZE if reliable else BUFFER_SIZE
+    buffers = [bytearray(size) for _ in range(BATCH_SIZE)]
+    views = [memoryview(buffer) for buffer in buffers]
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    if inbox is not None:
+        selector.register(inbox, selectors.EVENT_READ)
+
+    while True:
+        for key, _ in selector.select(endpoint.timeout() if endpoint else None):
+            if key.fileobj is inbox:
+                receive_registrations(inbox)
+            else:
+                drain_datagrams(sock, buffers, views, siblings, endpoint)
+        if endpoint:
+            endpoint.retransmit()
+
+def drain_datagrams(sock, buffers, views, siblings, endpoint=None):
+    # read until the socket is empty or every buffer is used, then send the replies.
+    # replies point into the buffers, so they go out before the buffers are reused
+    replies = []
+    for buffer, view in zip(buffers, views):
+        try:
+            size, addr = sock.recvfrom_into(buffer)
+        except BlockingIOError:
+            break
+
+        # acks and duplicates stop at the endpoint
+        start = 0
+        if endpoint:
+            if not endpoint.receive(view[:size], addr):
+                continue
+            start = rudp.HEADER_SIZE
+
+        space = buffer.find(b' ', start, size)
+        if space == -1:
+            register_client(bytes(view[start:size]), addr, siblings)
+            continue
+
+        target = client_dict.get(bytes(view[start:space]))
+        if target is None:
+            replies.append((ERROR_MESSAGE.encode(), addr))
         else:
-            sock.sendto(message.encode(),client_dict[target_customer])
\ No newline at end of file
+            replies.append((view[space + 1:size], target))
+
+    if endpoint:
+        endpoint.flush_acks()
+        for data, addr in replies:
+            endpoint.sendto(data, addr)
+        return
+
+    for data, addr in replies:
+        try:
+            sock.sendto(data, addr)
+        except BlockingIOError:
+            # the send buffer is full, drop it like the network would
+            pass
+
+def register_client(name, addr, siblings=()):
+    if name in client_dict:
+        return
+    client_dict[name]=addr
+    print(name.decode(errors='replace'),"-->Connected to the server!!!")
+
+    # a sibling worker may receive the messages for this client
+    record = name + b'\0' + f'{addr[0]}:{addr[1]}'.encode()
+    for sibling in siblings:
+        sibling.send(record)
+
+def receive_registrations(inbox):
+    while True:
+        try:
+            record = inbox.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        name, _, addr = record.partition(b'\0')
+        ip, port = addr.decode().rsplit(':', 1)
+        client_dict.setdefault(name, (ip, int(port)))
+
+def spawn_workers(count):
+    # one unix datagram pair per worker, a worker reads its own pair and
+    # writes registrations into the pairs of all the others
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+    for index in range(count):
+        # the parent process becomes the last worker
+        if index == count - 1 or os.fork() == 0:
+            inbox = pairs[index][0]
+            inbox.setblocking(False)
+            siblings = [pair[1] for i, pair in enumerate(pairs) if i != index]
+            serve_fast(open_socket(reuse_port=True), siblings, inbox)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--fast', action='store_true', help='drain datagrams in batches with a selector loop')
+parser.add_argument('--workers', type=int, default=1, help='fast mode worker processes sharing the port')
+parser.add_argument('--reliable', action='store_true',
+                    help='number, ack and retransmit every datagram, clients need --reliable too')
+args = parser.parse_args()
+
+# a client's acks for what another worker sent it could reach any worker
+if args.reliable and args.workers > 1:
+    parser.error('--reliable keeps its state in one process, it does not work with --workers')
+
+if args.workers > 1:
+    spawn_workers(args.workers)
+elif args.fast:
+    serve_fast(open_socket(), reliable=args.reliable)
+elif args.reliable:
+    serve(rudp.Endpoint(open_socket()))
+else:
+    serve(open_socket())